@@ -4,17 +4,34 @@ Score multiple alignments using multiple scorers.  Save scores for future
 retrieval in evaluators.
 """
 import argparse
+from collections import defaultdict
+import glob
 import multiprocessing
 import os
+import Queue
+import signal
 import sys
 import time
 import yaml
 
-from conseval.alignment import Alignment
+from conseval.alignment import Alignment, scan_alignment_size
 from conseval.datasets import DATASET_CONFIGS
-from conseval.io import write_batchscores, list_scorer_params, OUTPUT_DIR
+from conseval.io import list_scorer_params, read_params_fingerprint, \
+        read_metrics, write_metrics, read_align_params, write_align_params, \
+        OUTPUT_DIR
+from conseval.phylotree import format_tree_cache_stats, has_cached_phylotree, \
+        set_max_phyml_procs, tree_cache_stats
 from conseval.scorer import get_scorer
+from conseval.scorestore import ScoreStore
 from conseval.utils import parallelize
+from conseval.utils.general import get_timestamp
+
+
+# Guesses of the time in seconds a scorer takes per sequence per column, for
+# scheduling when there are no metrics from past runs.  Scorers that use a
+# tree may have to wait for it to be computed.
+DEFAULT_SECONDS_PER_CELL = .000001
+DEFAULT_SECONDS_PER_CELL_TREE = .0001
 
 
 
@@ -30,6 +47,18 @@ def read_batchscore_config(config_file):
     # List of dataset names
     datasets = config['datasets']
 
+    # Params for each alignment, e.g. max_sequences.
+    align_params = config.get('align_params') or {}
+
+    # Number of scoring processes, and max number of PhyML processes run
+    # alongside them to compute trees ahead of the scorers that use them.
+    # Also, the max time in seconds to score one alignment, and the number of
+    # alignments after which each scoring process is replaced.
+    parallel_params = {}
+    for k in ('procs', 'tree_procs', 'timeout', 'max_tasks_per_child'):
+        if config.get(k):
+            parallel_params[k] = int(config[k])
+
     # List of scoring runs with the run id, scorer, and params.
     # Initialize the scorers
     scorers = []
@@ -47,8 +76,26 @@ def read_batchscore_config(config_file):
             params = {}
         scorer = get_scorer(scorer_name, **params)
         scorer.set_output_id(batchscore_id)
+        scorer.set_align_params(align_params)
         scorers.append(scorer)
-    return datasets, scorers
+    return datasets, scorers, align_params, parallel_params
+
+
+def read_seconds_per_cell(metrics_dir):
+    """
+    Read the metrics files of past runs in `metrics_dir`, and get a dict
+    mapping scorer names to their average time in seconds per sequence per
+    column.
+    """
+    tot_seconds = {}
+    tot_cells = {}
+    for fname in glob.glob(os.path.join(metrics_dir, "metrics-*.txt")):
+        for record in read_metrics(fname):
+            name = record['scorer']
+            tot_seconds[name] = tot_seconds.get(name, 0) + record['wall_time']
+            tot_cells[name] = tot_cells.get(name, 0) + record['n_seqs'] * record['n_sites']
+    return dict((name, tot_seconds[name] / tot_cells[name])
+            for name in tot_seconds if tot_cells[name])
 
 
 
@@ -56,7 +103,9 @@ def read_batchscore_config(config_file):
 # Parallelization routines and helpers
 ################################################################################
 
-def run_experiments(dataset_name, scorers, limit=0):
+def run_experiments(dataset_name, scorers, align_params={}, limit=0,
+        procs=0, tree_procs=0, timeout=None, max_tasks_per_child=None,
+        metrics_dir=None):
     """
     Returns iterator over lists of tuples of scores.
 
@@ -68,12 +117,45 @@ def run_experiments(dataset_name, scorers, limit=0):
         name of dataset to use
     @param scorers:
         scorers to use
+    @param align_params:
+        params to pass to each Alignment
     @param limit:
         Max number of alignments to score (TODO)
+    @param procs:
+        Number of scoring processes.  Defaults to the number of CPUs.
+    @param tree_procs:
+        Max number of PhyML processes computing trees at once, whether run
+        by the scoring processes or by tree builders.  If any scorer uses
+        PhyML trees, up to this many tree builders compute the trees that
+        are not yet cached ahead of the scoring processes, which meanwhile
+        run the scorers that don't use trees.  Defaults to half of `procs`
+        (see get_default_tree_procs).
+    @param timeout:
+        Max time in seconds to score one alignment with all scorers.  If
+        exceeded, the alignment's remaining scorers are skipped.
+    @param max_tasks_per_child:
+        If set, replace each scoring process after it has scored this many
+        alignments, to free memory.
+    @param metrics_dir:
+        Directory to write this run's metrics file to, i.e. the time and
+        memory each scorer took on each alignment (see Scorer.score).  The
+        metrics of past runs in it are used to estimate the time each
+        alignment will take; alignments are scored in order of decreasing
+        estimated time, so that long ones don't hold up the end of the run.
     """
     dataset_config = DATASET_CONFIGS[dataset_name]
     align_files = dataset_config.get_align_files(limit)
 
+    # Skip alignments already scored by all scorers, e.g. when resuming.
+    stores = dict((scorer.output_id, ScoreStore(scorer.output_dir, scorer)) for scorer in scorers)
+    todo = get_todo_scorers(dataset_config, align_files, scorers, stores)
+    align_files = [af for af in align_files if todo[af]]
+
+    # Longest first.
+    seconds_per_cell = read_seconds_per_cell(metrics_dir) if metrics_dir else {}
+    costs = estimate_costs(align_files, todo, align_params, seconds_per_cell)
+    align_files.sort(key=lambda af: costs[af], reverse=True)
+
     count = 0
     tot = len(align_files)
     sys.stderr.write("\nDataset: %s\n" % dataset_name)
@@ -85,38 +167,115 @@ def run_experiments(dataset_name, scorers, limit=0):
     if not align_files:
         return
 
-    run_experiment = run_experiment_helper(dataset_config, scorers)
+    run_experiment = run_experiment_helper(dataset_config, scorers, align_params, stores)
 
     # Shortcut if no parallelization.  Also helps debugging.
     no_parallel = (len(align_files) == 1)
 
-    if no_parallel:
-        it = ((af, run_experiment(af)) for af in align_files)
+    if metrics_dir:
+        metrics_file = os.path.join(metrics_dir, "metrics-%s.txt" % get_timestamp())
     else:
-        it = parallelize.imap_unordered(run_experiment, align_files)
+        metrics_file = None
 
+    tree_builders = []
+    # Tree cache counts, summed over all processes (see
+    # conseval.phylotree.tree_cache_stats).
+    tree_stats = defaultdict(int)
+    stats_queue = multiprocessing.Queue()
     t0 = time.time()
     t00 = t0
-    for align_file, success in it:
-        count += 1
-        if time.time() - t0 > 60:
-            dt = time.time() - t00
-            h = dt // 3600
-            m = (dt % 3600) // 60
-            s = dt % 60
-            sys.stderr.write("\nTime elapsed: %dh %dm %ds\n" % (h,m,s))
-            sys.stderr.write("Progress: %d / %d\n" % (count, tot))
-            t0 = time.time()
-
-
-def run_experiment_helper(dataset_config, scorers):
+    try:
+        if no_parallel:
+            it = ((af, run_experiment(af)) for af in align_files)
+        else:
+            if align_params.get('tree_method', 'phyml') == 'phyml' and \
+                    not align_params.get('tree_file'):
+                tree_align_files = get_uncached_tree_align_files(
+                        [af for af in align_files
+                            if any(scorer.USES_TREE for scorer in todo[af])],
+                        align_params)
+                if tree_align_files:
+                    tree_procs = tree_procs or get_default_tree_procs(procs)
+                    set_max_phyml_procs(tree_procs)
+                    tree_builders = start_tree_builders(tree_align_files, align_params,
+                            min(tree_procs, len(tree_align_files)), stats_queue)
+            it = parallelize.imap_unordered(run_experiment, align_files, nprocs=procs,
+                    timeout=timeout, max_tasks_per_child=max_tasks_per_child)
+
+        for align_file, res in it:
+            count += 1
+            if isinstance(res, parallelize.TaskError):
+                sys.stderr.write("\nError scoring %s: %s\n" % (align_file, res))
+            else:
+                metrics, stats = res
+                for k, v in stats.items():
+                    tree_stats[k] += v
+                if metrics_file:
+                    write_metrics(metrics_file, metrics)
+            if time.time() - t0 > 60:
+                dt = time.time() - t00
+                h = dt // 3600
+                m = (dt % 3600) // 60
+                s = dt % 60
+                sys.stderr.write("\nTime elapsed: %dh %dm %ds\n" % (h,m,s))
+                sys.stderr.write("Progress: %d / %d\n" % (count, tot))
+                t0 = time.time()
+        for p in tree_builders:
+            p.join()
+        for _ in tree_builders:
+            try:
+                stats = stats_queue.get(timeout=1)
+            except Queue.Empty:
+                # A tree builder died.
+                break
+            for k, v in stats.items():
+                tree_stats[k] += v
+    except:
+        # e.g. Ctrl-C.  Also kill the PhyML processes of the tree builders.
+        for p in tree_builders:
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        raise
+    finally:
+        # Remove the PhyML slots' temp dir.
+        set_max_phyml_procs(0)
+
+    if format_tree_cache_stats(tree_stats):
+        sys.stderr.write("%s\n" % format_tree_cache_stats(tree_stats))
+
+    # Consolidate the scores written by each process.
+    for store in stores.values():
+        store.merge()
+
+
+def get_default_tree_procs(procs=0):
+    """
+    Default max number of PhyML processes run at once: half of `procs`, or
+    of the number of CPUs.
+    """
+    return max(1, (procs or multiprocessing.cpu_count()) // 2)
+
+
+def run_experiment_helper(dataset_config, scorers, align_params={}, stores={}):
     def run_experiment(align_file):
         """
         Run scorers on one aln file.  This is a helper for multithreading the
-        scoring of each aln file.
+        scoring of each aln file.  Returns a list of the metrics (see
+        Scorer.score) of the scorers that succeeded, and a dict of the
+        changes to tree_cache_stats.
         """
-        alignment = Alignment(align_file)
-        for scorer in scorers:
+        stats0 = dict(tree_cache_stats)
+        alignment = Alignment(align_file, **align_params)
+        metrics = []
+        # Run scorers that don't use the tree first, so the tree is likely
+        # ready (see start_tree_builders) by the time it is needed.
+        out_name = dataset_config.get_out_name(align_file)
+        for scorer in sorted(scorers, key=lambda scorer: scorer.USES_TREE):
+            store = stores[scorer.output_id]
+            if store.has(out_name):
+                continue
             # Score.
             try:
                 scores = scorer.score(alignment)
@@ -126,13 +285,116 @@ def run_experiment_helper(dataset_config, scorers):
                     (alignment.align_file, type(scorer).__name__))
                 traceback.print_exc()
                 continue
+            metrics.append(dict(scorer.metrics, id=scorer.output_id))
             # Write scores.
-            out_file = dataset_config.get_out_file(align_file, scorer.output_dir)
-            write_batchscores(out_file, scores)
-        return True
+            store.write(out_name, scores)
+        stats = dict((k, v - stats0.get(k, 0)) for k, v in tree_cache_stats.items())
+        return metrics, stats
     return run_experiment
 
 
+def get_todo_scorers(dataset_config, align_files, scorers, stores):
+    """
+    Get a dict mapping each of `align_files` to the list of `scorers` that
+    have not yet written its scores to their store in `stores`.
+    """
+    todo = {}
+    for align_file in align_files:
+        out_name = dataset_config.get_out_name(align_file)
+        todo[align_file] = [scorer for scorer in scorers
+                if not stores[scorer.output_id].has(out_name)]
+    return todo
+
+
+def estimate_costs(align_files, todo, align_params, seconds_per_cell):
+    """
+    Estimate the time to score each alignment, from its size and the
+    scorers it needs.
+
+    @param todo:
+        output of get_todo_scorers
+    @param seconds_per_cell:
+        output of read_seconds_per_cell
+    @return:
+        dict mapping each of `align_files` to its estimated time in seconds
+    """
+    max_sequences = align_params.get('max_sequences', Alignment.MAX_SEQUENCES)
+    costs = {}
+    for align_file in align_files:
+        n_seqs, n_cols = scan_alignment_size(align_file)
+        if max_sequences:
+            n_seqs = min(n_seqs, max_sequences)
+        cost = 0
+        for scorer in todo[align_file]:
+            if scorer.name in seconds_per_cell:
+                rate = seconds_per_cell[scorer.name]
+            elif scorer.USES_TREE:
+                rate = DEFAULT_SECONDS_PER_CELL_TREE
+            else:
+                rate = DEFAULT_SECONDS_PER_CELL
+            cost += rate * n_seqs * n_cols
+        costs[align_file] = cost
+    return costs
+
+
+def get_uncached_tree_align_files(align_files, align_params):
+    """
+    Get those of `align_files` whose phylogenetic tree is not cached yet.
+    """
+    res = []
+    for align_file in align_files:
+        try:
+            alignment = Alignment(align_file, **align_params)
+            if has_cached_phylotree(alignment):
+                continue
+        except Exception:
+            # The scoring process will report the error.
+            pass
+        res.append(align_file)
+    return res
+
+
+def start_tree_builders(align_files, align_params, nprocs, stats_queue):
+    """
+    Start `nprocs` processes that compute and cache the phylogenetic trees of
+    `align_files`, in order.  Scoring processes asking for a tree that is
+    being computed wait for it, see conseval.phylotree.get_phylotree.  Each
+    process puts its tree_cache_stats on `stats_queue` when done.
+
+    @return:
+        list of the started processes
+    """
+    q_in = multiprocessing.Queue()
+
+    def build_trees():
+        # Leave Ctrl-C to the parent, which kills the process group so that
+        # PhyML is killed too.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        os.setpgrp()
+        while True:
+            align_file = q_in.get()
+            if align_file is None:
+                stats_queue.put(dict(tree_cache_stats))
+                break
+            try:
+                Alignment(align_file, **align_params).get_phylotree()
+            except Exception:
+                # The scoring process will report the error when it
+                # computes the tree itself.
+                pass
+
+    procs = [multiprocessing.Process(target=build_trees) for _ in xrange(nprocs)]
+    for p in procs:
+        p.daemon = True
+        p.start()
+    for align_file in align_files:
+        q_in.put(align_file)
+    for _ in xrange(nprocs):
+        q_in.put(None)
+    q_in.close()
+    return procs
+
+
 
 ################################################################################
 # Cmd line driver
@@ -144,10 +406,13 @@ def main():
 
     parser.add_argument('config_file',
         help="YAML config file specifying the dataset and scorers.  See `exapmles/example.yaml` for an example.")
+    parser.add_argument('-r', dest='resume', action='store_true',
+        help="resume previous runs: keep the existing output of scorers whose params are unchanged, and only score the alignments they are missing. Scorers not yet run are run on all alignments.")
     args = parser.parse_args()
 
 
-    dataset_names, scorers = read_batchscore_config(args.config_file)
+    dataset_names, scorers, align_params, parallel_params = \
+            read_batchscore_config(args.config_file)
 
     # Sanity check the output dirs
     for ds_name in dataset_names:
@@ -157,7 +422,17 @@ def main():
         for scorer in scorers:
             sc_dir = os.path.join(ds_dir, scorer.output_id)
             if os.path.exists(sc_dir):
-                resp = raw_input("%s exists. Overwrite? y/[n]: " % sc_dir)
+                if args.resume:
+                    params_file = os.path.join(ds_dir, "%s.params" % scorer.output_id)
+                    if os.path.exists(params_file) and \
+                            read_params_fingerprint(params_file) == scorer.fingerprint:
+                        # Runs from before align params were recorded.
+                        if read_align_params(params_file) is None:
+                            write_align_params(params_file, align_params)
+                        continue
+                    resp = raw_input("%s exists, but with different params. Overwrite? y/[n]: " % sc_dir)
+                else:
+                    resp = raw_input("%s exists. Overwrite? y/[n]: " % sc_dir)
                 if resp != 'y':
                     sys.exit(0)
                 try:
@@ -172,12 +447,16 @@ def main():
         ds_dir = os.path.join(OUTPUT_DIR, "batchscore-%s" % ds_name)
         for scorer in scorers:
             sc_dir = os.path.join(ds_dir, scorer.output_id)
-            os.mkdir(sc_dir)
-            params_file = os.path.join(ds_dir, "%s.params" % scorer.output_id)
-            with open(params_file, 'w') as f:
-                f.write(list_scorer_params(scorer))
+            if not os.path.exists(sc_dir):
+                os.mkdir(sc_dir)
+                params_file = os.path.join(ds_dir, "%s.params" % scorer.output_id)
+                with open(params_file, 'w') as f:
+                    f.write(list_scorer_params(scorer))
+                    f.write("# Fingerprint: %s\n" % scorer.fingerprint)
+                write_align_params(params_file, align_params)
             scorer.set_output_dir(sc_dir)
-        run_experiments(ds_name, scorers)
+        run_experiments(ds_name, scorers, align_params,
+                metrics_dir=ds_dir, **parallel_params)
 
 
 if __name__ == "__main__":
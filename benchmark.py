@@ -0,0 +1,267 @@
+#!/usr/bin/python
+"""
+Benchmark how the scorers, tree construction and sequence weighting scale
+with the number of sequences, the alignment length and the tree shape, on
+synthetic alignments.  Results are written to JSON, and can be compared
+against the results of an earlier run to catch regressions.
+"""
+from __future__ import division
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import socket
+import sys
+import time
+
+from conseval.alignment import MockAlignment
+from conseval.io import OUTPUT_DIR
+from conseval.phylotree import compute_nj_tree, compute_phyml_tree
+from conseval.scorer import get_scorer, get_scorer_cls
+from conseval.seqweights import compute_seq_weights
+from conseval.simulation import simulate_alignment, TREE_SHAPES
+from conseval.substitution import SubstitutionModel
+from conseval.utils.general import get_all_module_names, get_timestamp
+
+
+# Results faster than this are too noisy to compare.
+MIN_COMPARE_TIME = .01
+
+
+
+################################################################################
+# Benchmark tasks
+################################################################################
+
+def get_tasks(names=None, phyml=False):
+    """
+    Get a list of (task name, function to time on an alignment).  Tasks are
+    every scorer in scorers/, 'tree.nj' and 'tree.bionj' (neighbor joining),
+    'tree.phyml' if `phyml` is set, and 'seq_weights'.  If `names` is given,
+    only get those tasks.
+    """
+    tasks = [
+        ('tree.nj', lambda aln: compute_nj_tree(aln.msa_array, aln.names)),
+        ('tree.bionj', lambda aln: compute_nj_tree(aln.msa_array, aln.names, bionj=True)),
+        ('seq_weights', lambda aln: compute_seq_weights(aln.msa_array)),
+    ]
+    if phyml:
+        tasks.append(('tree.phyml', lambda aln: compute_phyml_tree(aln)))
+    for scorer_name in get_all_module_names('scorers'):
+        if names and scorer_name not in names:
+            continue
+        try:
+            if not get_scorer_cls(scorer_name):
+                continue
+            scorer = get_scorer(scorer_name)
+        except Exception, e:
+            sys.stderr.write("Skipping scorer %s: %s\n" % (scorer_name, e))
+            continue
+        tasks.append((scorer_name, scorer.score))
+    if names:
+        tasks = [(name, fn) for name, fn in tasks if name in names]
+    return tasks
+
+
+def copy_alignment(alignment):
+    """
+    Copy of `alignment` without the data cached by scorers, except the
+    sequence weights, which are timed separately.
+    """
+    seq_weights = alignment.get_seq_weights()
+    aln = MockAlignment(alignment.names, alignment.msa_array, alignment.tree,
+            lambda: seq_weights)
+    aln.align_file = None
+    # Scorers such as intrepid look for weights cached here, as on an
+    # Alignment.
+    aln._seq_weights = None
+    return aln
+
+
+def run_benchmarks(tasks, sub_model, n_seqs_list, n_sites_list, tree_shapes,
+        repeats=3, max_time=60., seed=0, **sim_params):
+    """
+    Time each of `tasks` on a synthetic alignment of each size and tree
+    shape, `repeats` times.  Once a task takes longer than `max_time` on an
+    alignment, it is skipped on larger alignments of that tree shape.  Once
+    a task fails, it is skipped on all alignments of that tree shape.
+
+    @return:
+        list of result dicts, with keys task, n_seqs, n_sites, tree_shape,
+        times and best (the min of times)
+    """
+    results = []
+    # Per (task, tree shape), the size (in cells) at which the task got too
+    # slow.
+    too_slow = {}
+    for tree_shape in tree_shapes:
+        for n_seqs in n_seqs_list:
+            for n_sites in n_sites_list:
+                random_state = np.random.RandomState(
+                        [seed, n_seqs, n_sites, TREE_SHAPES.index(tree_shape)])
+                alignment = simulate_alignment(n_seqs, n_sites, sub_model,
+                        tree_shape=tree_shape, random_state=random_state, **sim_params)
+                for name, fn in tasks:
+                    if n_seqs * n_sites >= too_slow.get((name, tree_shape), np.inf):
+                        continue
+                    times = []
+                    try:
+                        for _ in xrange(repeats):
+                            aln = copy_alignment(alignment)
+                            t0 = time.time()
+                            fn(aln)
+                            times.append(time.time() - t0)
+                            if times[-1] > max_time:
+                                too_slow[name, tree_shape] = n_seqs * n_sites
+                                break
+                    except Exception, e:
+                        sys.stderr.write("%s\t%d x %d\t%s\tfailed: %s\n" % (tree_shape,
+                            n_seqs, n_sites, name, e))
+                        too_slow[name, tree_shape] = 0
+                        continue
+                    result = dict(task=name, n_seqs=n_seqs, n_sites=n_sites,
+                            tree_shape=tree_shape, times=times, best=min(times))
+                    results.append(result)
+                    sys.stderr.write("%s\t%d x %d\t%s\t%.4fs\n" % (tree_shape,
+                        n_seqs, n_sites, name, result['best']))
+    return results
+
+
+def get_machine_info():
+    info = {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    info['cpu_model'] = line.split(':', 1)[1].strip()
+                    break
+    except IOError:
+        pass
+    return info
+
+
+
+################################################################################
+# Comparison
+################################################################################
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compare the best times in `results` to those of the same tasks and sizes
+    in `baseline`, and print them.  Return the comparisons slower than the
+    baseline by more than a factor of `tolerance`.
+    """
+    key = lambda r: (r['task'], r['n_seqs'], r['n_sites'], r['tree_shape'])
+    baseline_best = dict((key(r), r['best']) for r in baseline)
+    regressions = []
+    print "# task\tshape\tsize\tbest\tbaseline\tratio"
+    for r in results:
+        base = baseline_best.get(key(r))
+        if base is None:
+            continue
+        ratio = r['best'] / max(base, 1e-9)
+        flag = ""
+        if ratio > tolerance and max(r['best'], base) >= MIN_COMPARE_TIME:
+            regressions.append(r)
+            flag = "\tREGRESSION"
+        print "%s\t%s\t%dx%d\t%.4f\t%.4f\t%.2f%s" % (r['task'], r['tree_shape'],
+                r['n_seqs'], r['n_sites'], r['best'], base, ratio, flag)
+    return regressions
+
+
+
+################################################################################
+# Cmd line driver
+################################################################################
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark scorers, tree construction and sequence weighting on synthetic alignments of increasing size.")
+
+    parser.add_argument('-t', dest='tasks', type=lambda s: s.split(','),
+        help="comma-separated tasks to run: scorer names (e.g. cs07.js_divergence), tree.nj, tree.bionj, tree.phyml, seq_weights.  Default: all but tree.phyml")
+    parser.add_argument('--phyml', action='store_true',
+        help="also time tree construction by PhyML, which must be installed")
+    parser.add_argument('--seqs', type=int_list, default=[10,25,50,100,200],
+        help="comma-separated numbers of sequences (default: %(default)s)")
+    parser.add_argument('--sites', type=int_list, default=[100,300,1000],
+        help="comma-separated numbers of sites (default: %(default)s)")
+    parser.add_argument('--shapes', type=lambda s: s.split(','), default=['random'],
+        help="comma-separated tree shapes, of %s (default: %%(default)s)" % ", ".join(TREE_SHAPES))
+    parser.add_argument('--sub_model', default='sub_models/lg_LG.PAML.txt',
+        help="substitution model to simulate under (default: %(default)s)")
+    parser.add_argument('--alpha', type=float, default=1.,
+        help="shape of the gamma distribution of rates (default: %(default)s)")
+    parser.add_argument('--branch_length', type=float, default=.1,
+        help="mean branch length (default: %(default)s)")
+    parser.add_argument('--gap_fraction', type=float, default=.05,
+        help="fraction of residues replaced by gaps (default: %(default)s)")
+    parser.add_argument('--repeats', type=int, default=3,
+        help="times to run each task on each alignment (default: %(default)s)")
+    parser.add_argument('--max_time', type=float, default=60.,
+        help="skip a task on larger alignments once it takes longer than this many seconds (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+        help="random seed (default: %(default)s)")
+    parser.add_argument('-o', dest='out_file',
+        help="JSON file to write results to (default: output/benchmark-<timestamp>.json)")
+    parser.add_argument('-b', dest='baseline',
+        help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+        help="report a regression if a task is slower than the baseline by more than this factor (default: %(default)s)")
+    parser.add_argument('-c', dest='compare', metavar='RESULTS',
+        help="don't run benchmarks, but compare the JSON results RESULTS to the baseline")
+    args = parser.parse_args()
+
+    if args.compare:
+        if not args.baseline:
+            parser.error("-c requires a baseline, -b")
+        with open(args.compare) as f:
+            results = json.load(f)['results']
+    else:
+        for shape in args.shapes:
+            if shape not in TREE_SHAPES:
+                parser.error("unknown tree shape %r" % shape)
+        tasks = get_tasks(args.tasks, args.phyml or (args.tasks and 'tree.phyml' in args.tasks))
+        sub_model = SubstitutionModel(os.path.abspath(args.sub_model))
+        config = dict((k, getattr(args, k)) for k in ('seqs', 'sites', 'shapes',
+            'sub_model', 'alpha', 'branch_length', 'gap_fraction', 'repeats',
+            'max_time', 'seed'))
+        config['tasks'] = [name for name, _ in tasks]
+        results = run_benchmarks(tasks, sub_model, args.seqs, args.sites,
+                args.shapes, args.repeats, args.max_time, args.seed,
+                alpha=args.alpha, branch_length=args.branch_length,
+                gap_fraction=args.gap_fraction)
+
+        out_file = args.out_file or os.path.join(OUTPUT_DIR,
+                "benchmark-%s.json" % get_timestamp())
+        if not os.path.exists(os.path.dirname(os.path.abspath(out_file))):
+            os.makedirs(os.path.dirname(os.path.abspath(out_file)))
+        with open(out_file, 'w') as f:
+            json.dump(dict(timestamp=get_timestamp(), machine=get_machine_info(),
+                config=config, results=results), f, indent=1, sort_keys=True)
+        sys.stderr.write("Wrote %s\n" % out_file)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print "\n%d regression(s) beyond a factor of %s" % (len(regressions), args.tolerance)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,91 @@
+import hashlib
 import random
 import os
+import numpy as np
 
 from conseval.params import Params, ParamDef, WithParams
-from conseval.phylotree import get_phylotree, read_phylotree, check_phylotree
+from conseval.phylotree import get_phylotree, read_phylotree, check_phylotree, \
+        TREE_METHODS
 from conseval.seqweights import get_seq_weights
-from conseval.utils.bio import iupac_alphabet, get_column
+from conseval.utils.bio import iupac_alphabet, encode_msa, decode_msa, \
+        get_column_patterns, weighted_freq_counts, GAP_INDEX
 
 
 ################################################################################
 # Alignment class
 ################################################################################
 
-class Alignment(WithParams):
+class _MsaArrayMixin(object):
+    """
+    Shared accessors for alignments stored as self.msa_array, a (sequences x
+    sites) uint8 array of indices into amino_acids (see encode_msa).
+
+    Classes using this must set self.msa_array and self.names, and initialize
+    self._msa, self._msa_hash and self._column_patterns to None and
+    self._freq_counts to {}.
+    """
+
+    @property
+    def msa(self):
+        """
+        List of equal-length lists of amino acids.  This is decoded from
+        self.msa_array on first access, and kept for compatibility; prefer
+        self.msa_array.
+        """
+        if self._msa is None:
+            self._msa = decode_msa(self.msa_array)
+        return self._msa
+
+    def get_column_patterns(self):
+        """
+        Unique column patterns of self.msa_array, as (patterns, counts,
+        site_patterns).  See conseval.utils.bio.get_column_patterns.  Scorers
+        that score each column independently only need to score each pattern
+        once.
+
+        Caches the computed patterns after the first call.
+        """
+        if self._column_patterns is None:
+            self._column_patterns = get_column_patterns(self.msa_array)
+        return self._column_patterns
+
+    def get_freq_counts(self, use_seq_weights=True):
+        """
+        (sites x len(amino_acids)) array of the counts of each amino acid (and
+        gaps) in each column, with each sequence weighted by get_seq_weights()
+        if `use_seq_weights` and by 1 otherwise.  See
+        conseval.utils.bio.weighted_freq_counts.
+
+        Caches the computed counts after the first call, so that all scorers
+        run on this alignment share them.
+        """
+        if use_seq_weights not in self._freq_counts:
+            if use_seq_weights:
+                seq_weights = self.get_seq_weights()
+            else:
+                seq_weights = np.ones(len(self.msa_array))
+            self._freq_counts[use_seq_weights] = weighted_freq_counts(self.msa_array, seq_weights)
+        return self._freq_counts[use_seq_weights]
+
+    def get_msa_hash(self):
+        """
+        Hex digest identifying the (filtered) sequences and names of this
+        alignment.  Used as the key for data cached on disk for it.
+        """
+        if self._msa_hash is None:
+            h = hashlib.sha1()
+            h.update("%d %d\n" % self.msa_array.shape)
+            h.update("\n".join(self.names) + "\n")
+            h.update(np.ascontiguousarray(self.msa_array).tostring())
+            self._msa_hash = h.hexdigest()
+        return self._msa_hash
+
+
+
+class Alignment(_MsaArrayMixin, WithParams):
+
+    # Default maximum number of sequences kept from an alignment.
+    MAX_SEQUENCES = 50
 
     params = Params(
         ParamDef("test_file", None,
@@ -20,22 +94,30 @@ class Alignment(WithParams):
             help="function to parse testset fields. Meaningful only if test_file set"),
         ParamDef("tree_file", None,
             help="path to custom phylogenetic tree to use for this alignment"),
+        ParamDef("tree_method", 'phyml', str, lambda x: x in TREE_METHODS,
+            help="method to compute the phylogenetic tree if tree_file is not set: 'phyml', or neighbor joining with 'nj' or 'bionj' (fast but approximate)"),
+        ParamDef("max_sequences", MAX_SEQUENCES, int, lambda x: x>=0,
+            help="maximum number of sequences to keep; larger alignments are randomly subsampled. If 0, keep all sequences"),
+        ParamDef("cache_dir", None, lambda x: os.path.abspath(x) if x else None,
+            help="directory to cache data computed for this alignment, e.g. sequence weights and phylogenetic trees. If not set, data is cached next to the alignment file"),
     )
 
-    MAX_SEQUENCES = 50
-
     def __init__(self, align_file, **params):
         """
         Loads/calculates input data for `align_file`.  Sets:
         - self.align_file: Filename this alignment was loaded from
-        - self.names: Names of sequences in self.msa
-        - self.msa: List of equal-length lists of nucleotides/AAs
+        - self.names: Names of sequences in self.msa_array
+        - self.msa_array: (sequences x sites) uint8 array of indices into
+          amino_acids.  It is stored column-major, so columns are contiguous.
         - self.testset: Test labels of each column, if available
 
-        self.msa is cleaned to have no more than self.MAX_SEQUENCES sequences. This
+        self.msa, the alignment as a list of equal-length lists of AAs, is
+        also available as a view of self.msa_array.
+
+        self.msa_array is cleaned to have no more than self.max_sequences sequences. This
         is so phylogenetic tree calculation does not take too long.
 
-        self.msa is cleaned so that the first sequence contains no gaps, and so that
+        self.msa_array is cleaned so that the first sequence contains no gaps, and so that
         no column contains all gaps.
         """
         super(Alignment, self).__init__(**params)
@@ -65,10 +147,10 @@ class Alignment(WithParams):
         # computation doesn't take too long.
         self.filtered = False
         self.orig_num_sequences = len(names)
-        if self.orig_num_sequences > self.MAX_SEQUENCES:
+        if self.max_sequences and self.orig_num_sequences > self.max_sequences:
             self.filtered = True
             random.seed(1000)
-            inds = random.sample(range(1,len(msa)), self.MAX_SEQUENCES-1)
+            inds = random.sample(range(1,len(msa)), self.max_sequences-1)
             names = [names[0]] + [names[ind] for ind in inds]
             msa = [msa[0]] + [msa[ind] for ind in inds]
 
@@ -77,24 +159,23 @@ class Alignment(WithParams):
         else:
             testset = None
 
-        inds = []
-        for i in xrange(len(msa[0])):
-            if msa[0][i] == '-':
-                continue
-            col = get_column(i, msa)
-            if col.count('-') == len(col):
-                continue
-            inds.append(i)
-        msa = [[row[i] for i in inds] for row in msa]
+        msa_array = encode_msa(msa)
+        is_gap = (msa_array == GAP_INDEX)
+        inds = np.flatnonzero(~is_gap[0] & ~np.all(is_gap, axis=0))
+        msa_array = np.asfortranarray(msa_array[:,inds])
         if testset:
             testset = [testset[i] for i in inds]
 
         self.align_file = os.path.abspath(align_file)
         self.names = names
-        self.msa = msa
+        self.msa_array = msa_array
         self.testset = testset
+        self._msa = None
+        self._msa_hash = None
         self._phylotree = None
         self._seq_weights = None
+        self._column_patterns = None
+        self._freq_counts = {}
 
 
     def get_phylotree(self, n_bootstrap=0, overwrite=False):
@@ -131,15 +212,21 @@ class Alignment(WithParams):
         return self._seq_weights
 
 
-class MockAlignment():
+class MockAlignment(_MsaArrayMixin):
     """
     Helpful for classes wanting to generate alignments not from files.
+    `msa` may be a list of equal-length strings or lists of AAs, or an array
+    as returned by encode_msa.
     """
     def __init__(self, names, msa, tree, get_seq_weights):
         self.names = names
-        self.msa = msa
+        self.msa_array = encode_msa(msa)
         self.tree = tree
         self.get_seq_weights = get_seq_weights
+        self._msa = None
+        self._msa_hash = None
+        self._column_patterns = None
+        self._freq_counts = {}
 
     def get_phylotree(self):
         return self.tree
@@ -186,6 +273,38 @@ def read_fasta_alignment(filename):
     return names, msa
 
 
+def scan_alignment_size(filename):
+    """
+    Quickly get the number of sequences and the number of columns in the
+    CLUSTAL or FASTA alignment in filename, without parsing the sequences.
+    This is only an estimate of the size of the Alignment loaded from it,
+    which filters sequences and columns.
+    """
+    n_seqs = 0
+    n_cols = 0
+    names = set()
+    first_name = None
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('>'):
+                # FASTA
+                n_seqs += 1
+            elif n_seqs:
+                if n_seqs == 1:
+                    n_cols += len(line.strip())
+            elif line[:1].strip() and 'CLUSTAL' not in line:
+                # CLUSTAL: lines of name and part of its sequence.
+                t = line.split()
+                if len(t) != 2:
+                    continue
+                if first_name is None:
+                    first_name = t[0]
+                if t[0] == first_name:
+                    n_cols += len(t[1])
+                names.add(t[0])
+    return n_seqs or len(names), n_cols
+
+
 def read_clustal_alignment(filename):
     """
     Read in the alignment stored in the CLUSTAL file, filename. Return
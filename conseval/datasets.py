@@ -55,9 +55,15 @@ class DatasetConfig(object):
         return os.path.join(self.test_dir,
                 self._align_to_test_fn(align_file[len(self.aln_dir)+1:]))
 
+    def get_out_name(self, align_file):
+        """
+        Name identifying `align_file` in batchscore output, e.g. its key in a
+        ScoreStore.
+        """
+        return ".".join(align_file[len(self.aln_dir)+1:].replace('/', '___').split('.')[:-1])
+
     def get_out_file(self, align_file, out_dir, ext='.res'):
-        out_name = ".".join(align_file[len(self.aln_dir)+1:].replace('/', '___').split('.')[:-1])
-        return os.path.join(out_dir, out_name + ext)
+        return os.path.join(out_dir, self.get_out_name(align_file) + ext)
 
 
 
@@ -1,5 +1,7 @@
+import hashlib
+import json
 import os
-from conseval.utils.general import get_timestamp
+from conseval.utils.general import atomic_write, get_timestamp
 
 
 OUTPUT_DIR = os.path.abspath("output")
@@ -24,10 +26,13 @@ def read_score_helper(field):
 
 
 def write_batchscores(fname, scores):
+    """
+    Write `scores` to `fname`.  The file is written atomically, so if it
+    exists, it is complete.
+    """
     if os.path.exists(fname):
         raise IOError("batchscores file %s already exists" % fname)
-    with open(fname, 'w') as f:
-        f.write("\n".join(map(write_score_helper, scores)))
+    atomic_write(fname, "\n".join(map(write_score_helper, scores)))
 
 
 def read_batchscores(fname):
@@ -46,6 +51,91 @@ def list_scorer_params(*scorers):
     return "\n".join(out) + "\n"
 
 
+def get_params_fingerprint(scorer, align_params={}):
+    """
+    Hex digest identifying the scores computed by `scorer` on alignments
+    loaded with `align_params`.  Batch scoring runs can be resumed only if
+    this hasn't changed.
+    """
+    h = hashlib.sha1()
+    h.update(scorer.name + "\n")
+    for k, v in scorer.get_params():
+        h.update("%s: %r\n" % (k, v))
+    for k, v in sorted(align_params.items()):
+        h.update("align %s: %r\n" % (k, v))
+    return h.hexdigest()
+
+
+def read_params_fingerprint(params_file):
+    """
+    Read the fingerprint written to a batchscore .params file, or return None
+    if there is none.
+    """
+    with open(params_file) as f:
+        for line in f:
+            if line.startswith("# Fingerprint: "):
+                return line.split(":", 1)[1].strip()
+    return None
+
+
+def write_align_params(params_file, align_params):
+    """
+    Append the alignment params of a batchscore run to its .params file, so
+    evaluators can load alignments as they were scored.
+    """
+    with open(params_file, 'a') as f:
+        f.write("# Align params: %s\n" % json.dumps(align_params, sort_keys=True))
+
+
+def read_align_params(params_file):
+    """
+    Read the alignment params written to a batchscore .params file by
+    write_align_params, or return None if there are none.
+    """
+    with open(params_file) as f:
+        for line in f:
+            if line.startswith("# Align params: "):
+                return json.loads(line.split(":", 1)[1])
+    return None
+
+
+# Fields of the records in metrics files, see Scorer.score.  `id` is the
+# batchscore id of the scorer.
+METRICS_FIELDS = ('align_file', 'id', 'scorer', 'fingerprint', 'n_seqs',
+        'n_sites', 'wall_time', 'cpu_time', 'max_rss_delta')
+_METRICS_TYPES = (str, str, str, str, int, int, float, float, int)
+
+
+def write_metrics(fname, records):
+    """
+    Append `records`, dicts with keys METRICS_FIELDS, to the tab-separated
+    metrics file `fname`.
+    """
+    exists = os.path.exists(fname)
+    with open(fname, 'a') as f:
+        if not exists:
+            f.write("# %s\n" % "\t".join(METRICS_FIELDS))
+        for record in records:
+            f.write("\t".join(str(record[k]) for k in METRICS_FIELDS) + "\n")
+
+
+def read_metrics(fname):
+    """
+    Read the records in the metrics file `fname`, written by write_metrics.
+    """
+    records = []
+    with open(fname) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            vals = line.rstrip('\n').split('\t')
+            if len(vals) != len(METRICS_FIELDS):
+                continue
+            records.append(dict((k, t(v)) for k, t, v in
+                zip(METRICS_FIELDS, _METRICS_TYPES, vals)))
+    return records
+
+
 def parse_params(params):
     res = {}
     for val in params:
@@ -1,7 +1,42 @@
 from Bio import Phylo, SeqIO
+from Bio.Phylo.BaseTree import Clade, Tree
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
+from collections import defaultdict
+from cStringIO import StringIO
+import fcntl
+import hashlib
 import os
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+from conseval.utils.bio import GAP_INDEX
+from conseval.utils.general import atomic_write
+
+
+# Options passed to PhyML, besides the input file and number of bootstraps.
+# These are part of the tree cache key, so changing them invalidates the cache.
+PHYML_OPTIONS = ["-d", "aa", "--quiet", "--no_memory_check"]
+
+# Per-process counts of tree cache events: 'hit', 'miss', and 'corrupt' (a
+# cached tree that could not be read or did not match its alignment).
+tree_cache_stats = defaultdict(int)
+
+# Lock files bounding the number of PhyML processes run at once, shared with
+# child processes forked after they are set.  See set_max_phyml_procs.
+_phyml_slots = None
+
+# Methods for computing trees.  'phyml' runs PhyML (maximum likelihood); 'nj'
+# and 'bionj' build a neighbor-joining tree in-process, which is much faster
+# but only approximate.
+TREE_METHODS = ('phyml', 'nj', 'bionj')
+
+# Distance between sequences whose Kimura-corrected distance is undefined
+# (too divergent) or that share no ungapped sites.
+MAX_DISTANCE = 10.
 
 
 #####
@@ -12,46 +47,359 @@ def get_phylotree(alignment, n_bootstrap=0, overwrite=False):
     """
     Get the phylo tree corresponding to `alignment`.  If no tree, compute one
     and cache to disk.
+
+    Trees are cached under a key computed from the alignment's sequences and
+    `alignment.tree_method` with its options (see get_tree_cache_file), so a
+    cached tree is only reused for the exact same input.  Computing and
+    caching a tree is done while holding a lock on the cache entry, so
+    concurrent workers scoring the same alignment compute its tree only once.
     """
-    fname_phy = '.'.join(alignment.align_file.split('.')[:-1]) + '.phy'
-    fname_tree = fname_phy + '_phyml_tree.txt'
-    tree = None
-    if not overwrite and os.path.exists(fname_tree) and os.path.getsize(fname_tree):
-        tree = read_phylotree(fname_tree)
-        # Check that the cached tree matches the alignment. If not, re-compute.
-        if not check_phylotree(alignment, tree):
-            tree = None
-    if not tree:
-        tree = _compute_phylotree(alignment, fname_phy, fname_tree, n_bootstrap)
+    if alignment.tree_method != 'phyml' and n_bootstrap:
+        raise ValueError("Bootstrapping is only supported with tree_method 'phyml'")
+
+    fname_tree = get_tree_cache_file(alignment, n_bootstrap)
+    if not overwrite:
+        tree = _read_cached_phylotree(alignment, fname_tree)
+        if tree:
+            return tree
+
+    cache_dir = os.path.dirname(fname_tree)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created concurrently.
+            if not os.path.isdir(cache_dir):
+                raise
+    f_lock = _lock_cache_entry(fname_tree)
+    try:
+        # Another process may have computed the tree while we waited.
+        tree = None
+        if not overwrite:
+            tree = _read_cached_phylotree(alignment, fname_tree, count=False)
+            if tree:
+                tree_cache_stats['hit'] += 1
+                return tree
+            if n_bootstrap == 0 and alignment.tree_method == 'phyml':
+                tree = _read_legacy_phylotree(alignment)
+        if tree:
+            tree_cache_stats['hit'] += 1
+        else:
+            tree_cache_stats['miss'] += 1
+            if alignment.tree_method == 'phyml':
+                tree = compute_phyml_tree(alignment, cache_dir, n_bootstrap)
+            else:
+                tree = compute_nj_tree(alignment.msa_array, alignment.names,
+                        bionj=(alignment.tree_method == 'bionj'))
+        _write_phylotree(tree, fname_tree)
+    finally:
+        # Remove the lock file while still holding the lock, so it isn't
+        # left next to the alignment.  Processes waiting on it then lock a
+        # new one (see _lock_cache_entry), and find the cached tree.
+        try:
+            os.remove(fname_tree + '.lock')
+        except OSError:
+            pass
+        f_lock.close()
     return tree
 
 
+def has_cached_phylotree(alignment, n_bootstrap=0):
+    """
+    Whether get_phylotree would find a tree for `alignment` in the cache,
+    without computing one or updating tree_cache_stats.
+    """
+    fname_tree = get_tree_cache_file(alignment, n_bootstrap)
+    if _read_cached_phylotree(alignment, fname_tree, count=False):
+        return True
+    return n_bootstrap == 0 and alignment.tree_method == 'phyml' and \
+            _read_legacy_phylotree(alignment) is not None
+
+
+def format_tree_cache_stats(stats=None):
+    """
+    One-line summary of `stats`, counts like tree_cache_stats (by default,
+    this process'), or None if there were no tree cache lookups.
+    """
+    if stats is None:
+        stats = tree_cache_stats
+    if not any(stats.values()):
+        return None
+    return "Tree cache: %d hits, %d misses (computed), %d corrupt" % (
+            stats.get('hit', 0), stats.get('miss', 0), stats.get('corrupt', 0))
+
+
+def set_max_phyml_procs(n):
+    """
+    Allow at most `n` PhyML processes to run at once, across this process
+    and any processes forked from it afterwards.  If `n` is 0, don't bound.
+
+    Each PhyML run holds an flock on one of `n` lock files.  Unlike a
+    semaphore, the lock is released even if the process holding it is killed.
+    """
+    global _phyml_slots
+    if _phyml_slots:
+        shutil.rmtree(os.path.dirname(_phyml_slots[0]), ignore_errors=True)
+        _phyml_slots = None
+    if n:
+        slots_dir = tempfile.mkdtemp(prefix='conseval-phyml-')
+        _phyml_slots = [os.path.join(slots_dir, str(i)) for i in xrange(n)]
+
+
+def _lock_cache_entry(fname_tree):
+    """
+    Open and lock the lock file of the tree cache entry `fname_tree`.  Lock
+    files are removed once the entry is written, so if the file was removed
+    while we waited for its lock, lock the new one instead.
+    """
+    fname_lock = fname_tree + '.lock'
+    while True:
+        f_lock = open(fname_lock, 'w')
+        fcntl.flock(f_lock, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f_lock.fileno()).st_ino == os.stat(fname_lock).st_ino:
+                return f_lock
+        except OSError:
+            # Removed.
+            pass
+        f_lock.close()
+
+
+def _acquire_phyml_slot():
+    """
+    Wait for and lock one of _phyml_slots.  Returns the open lock file; the
+    slot is released when it is closed.
+    """
+    while True:
+        for slot in _phyml_slots:
+            f_lock = open(slot, 'w')
+            try:
+                fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f_lock
+            except IOError:
+                f_lock.close()
+        time.sleep(.1)
+
+
+def get_tree_cache_file(alignment, n_bootstrap=0):
+    """
+    Path of the cached tree for `alignment`.  Trees are cached in the
+    alignment's cache_dir if set, and next to the alignment file otherwise,
+    named by a hash of the alignment and the tree method: the PhyML options,
+    or the neighbor-joining variant.
+    """
+    h = hashlib.sha1()
+    h.update(alignment.get_msa_hash())
+    if alignment.tree_method == 'phyml':
+        h.update(" ".join(PHYML_OPTIONS + ["-b", str(n_bootstrap)]))
+    else:
+        h.update(alignment.tree_method)
+    cache_dir = alignment.cache_dir or os.path.dirname(alignment.align_file)
+    return os.path.join(cache_dir, h.hexdigest() + '.tree')
+
+
 def read_phylotree(fname_tree):
     return Phylo.read(fname_tree, "newick")
 
 
+def iter_clades(tree, order='preorder'):
+    """
+    List the clades of `tree` in 'preorder' or 'postorder', like
+    tree.find_clades(order=...), but without recursion, which overflows the
+    stack on deep trees, e.g. unbalanced trees of thousands of sequences.
+    """
+    if order not in ('preorder', 'postorder'):
+        raise ValueError("Unknown order %r" % order)
+    clades = []
+    stack = [tree.root]
+    while stack:
+        clade = stack.pop()
+        clades.append(clade)
+        stack += clade.clades[::-1] if order == 'preorder' else clade.clades
+    if order == 'postorder':
+        # Each clade follows its descendants, and children keep their order.
+        clades.reverse()
+    return clades
+
+
 def check_phylotree(alignment, tree):
     """
     Check that `tree` matches `alignment`.
     """
-    tree_terminals = tree.get_terminals()
+    tree_terminals = [clade for clade in iter_clades(tree) if clade.is_terminal()]
     return len(tree_terminals) == len(alignment.names) and \
             set(clade.name for clade in tree_terminals) == set(alignment.names)
 
 
-def _compute_phylotree(alignment, fname_phy, fname_tree, n_bootstrap):
+def _read_cached_phylotree(alignment, fname_tree, count=True):
+    """
+    Read the cached tree `fname_tree`, or return None if it doesn't exist or
+    is unusable.  Updates tree_cache_stats if `count`.
+    """
+    tree = None
+    if os.path.exists(fname_tree) and os.path.getsize(fname_tree):
+        try:
+            tree = read_phylotree(fname_tree)
+        except Exception:
+            tree = None
+        # Check that the cached tree matches the alignment. If not, re-compute.
+        if not tree or not check_phylotree(alignment, tree):
+            if count:
+                tree_cache_stats['corrupt'] += 1
+            tree = None
+        elif count:
+            tree_cache_stats['hit'] += 1
+    return tree
+
+
+def _read_legacy_phylotree(alignment):
+    """
+    Read the tree that older versions cached next to the alignment file, if
+    it exists and matches the alignment.
+    """
+    fname_tree = '.'.join(alignment.align_file.split('.')[:-1]) + '.phy_phyml_tree.txt'
+    if not os.path.exists(fname_tree) or not os.path.getsize(fname_tree):
+        return None
+    try:
+        tree = read_phylotree(fname_tree)
+    except Exception:
+        return None
+    if not check_phylotree(alignment, tree):
+        return None
+    return tree
+
+
+def _write_phylotree(tree, fname_tree):
     """
-    Use PhyML to compute the tree for fname_aln.
-    Does not compute tree if treefile exists and overwrite=False (default).
-    Return the filename of the tree.
+    Atomically write `tree` to `fname_tree`.
     """
-    records = []
-    for row,name in zip(alignment.msa, alignment.names):
-        records.append(SeqRecord(Seq(''.join(row)), id=name, description=name))
-    with open(fname_phy, "w") as f_out:
-        SeqIO.write(records, f_out, "phylip-relaxed")
-    os.system("phyml -i %s -d aa -b %d --quiet --no_memory_check" % (fname_phy, n_bootstrap))
-    return read_phylotree(fname_tree)
+    out = StringIO()
+    Phylo.write(tree, out, "newick")
+    atomic_write(fname_tree, out.getvalue())
+
+
+def compute_phyml_tree(alignment, work_dir=None, n_bootstrap=0):
+    """
+    Use PhyML to compute the tree for `alignment`, without caching it (see
+    get_phylotree).  PhyML's input and output files are kept in a private
+    temporary directory in `work_dir`, by default the system's temp dir,
+    which is removed afterwards.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=work_dir, prefix='.phyml-')
+    try:
+        fname_phy = os.path.join(tmp_dir, 'aln.phy')
+        fname_tree = fname_phy + '_phyml_tree.txt'
+        records = []
+        for row,name in zip(alignment.msa, alignment.names):
+            records.append(SeqRecord(Seq(''.join(row)), id=name, description=name))
+        with open(fname_phy, "w") as f_out:
+            SeqIO.write(records, f_out, "phylip-relaxed")
+        cmd = ["phyml", "-i", fname_phy, "-b", str(n_bootstrap)] + PHYML_OPTIONS
+        if _phyml_slots:
+            with _acquire_phyml_slot():
+                subprocess.call(cmd)
+        else:
+            subprocess.call(cmd)
+        if not os.path.exists(fname_tree):
+            raise RuntimeError("PhyML failed to compute a tree for %s" % alignment.align_file)
+        return read_phylotree(fname_tree)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+#####
+# Neighbor joining
+#####
+
+def compute_distance_matrix(msa_array):
+    """
+    Pairwise distances between the sequences of `msa_array`, a (sequences x
+    sites) array as returned by encode_msa.  The proportion p of differing
+    residues over the sites where both sequences are ungapped is corrected
+    for multiple substitutions with Kimura's protein distance,
+    d = -ln(1 - p - 0.2 p^2), and capped at MAX_DISTANCE.
+    """
+    msa_array = np.asarray(msa_array)
+    n_seqs = len(msa_array)
+    # Count matching residues one amino acid at a time, so memory stays
+    # O(sequences x sites).  float32 holds counts exactly, and its products
+    # are faster than integer ones.
+    n_same = np.zeros((n_seqs, n_seqs))
+    for aa in xrange(GAP_INDEX):
+        is_aa = (msa_array == aa).astype(np.float32)
+        n_same += np.dot(is_aa, is_aa.T)
+    not_gap = (msa_array != GAP_INDEX).astype(np.float32)
+    n_sites = np.dot(not_gap, not_gap.T).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = 1 - n_same / n_sites
+        d = -np.log(1 - p - .2*np.square(p))
+        d[~np.isfinite(d) | (d > MAX_DISTANCE)] = MAX_DISTANCE
+    np.fill_diagonal(d, 0)
+    return d
+
+
+def compute_nj_tree(msa_array, names, bionj=False):
+    """
+    Build an unrooted tree over the sequences of `msa_array` by neighbor
+    joining (SaitouNei1987) on compute_distance_matrix distances.  If
+    `bionj`, use BIONJ (Gascuel1997), which weights the reduced distances by
+    their variances.
+
+    @param msa_array:
+        (sequences x sites) array as returned by encode_msa
+    @param names:
+        names of the sequences in msa_array, used as the names of the leaves
+    @return:
+        Bio.Phylo tree whose root has 3 children (2 if only 2 sequences),
+        like the trees computed by PhyML.
+    """
+    D = compute_distance_matrix(msa_array)
+    V = D.copy()
+    nodes = [Clade(name=name, branch_length=0.) for name in names]
+    if len(nodes) == 1:
+        return Tree(root=nodes[0], rooted=False)
+    active = np.ones(len(nodes), dtype=bool)
+
+    while np.sum(active) > 3:
+        inds = np.flatnonzero(active)
+        m = len(inds)
+        D_a = D[np.ix_(inds, inds)]
+        r = np.sum(D_a, axis=1)
+        Q = (m-2)*D_a - r[:,np.newaxis] - r[np.newaxis,:]
+        np.fill_diagonal(Q, np.inf)
+        a, b = np.unravel_index(np.argmin(Q), Q.shape)
+        i, j = inds[a], inds[b]
+
+        d_iu = .5*D[i,j] + (r[a]-r[b]) / (2.*(m-2))
+        d_iu = min(max(d_iu, 0), D[i,j])
+        d_ju = D[i,j] - d_iu
+        nodes[i].branch_length = d_iu
+        nodes[j].branch_length = d_ju
+
+        if bionj and V[i,j] > 0:
+            lam = .5 + (np.sum(V[j,inds]) - np.sum(V[i,inds])) / (2.*(m-2)*V[i,j])
+            lam = min(max(lam, 0), 1)
+        else:
+            lam = .5
+        # Store the new node u in place of i.
+        D_u = lam*(D[i]-d_iu) + (1-lam)*(D[j]-d_ju)
+        V_u = lam*V[i] + (1-lam)*V[j] - lam*(1-lam)*V[i,j]
+        D[i,:] = D[:,i] = np.maximum(D_u, 0)
+        V[i,:] = V[:,i] = V_u
+        D[i,i] = V[i,i] = 0
+        nodes[i] = Clade(branch_length=0., clades=[nodes[i], nodes[j]])
+        active[j] = False
+
+    inds = np.flatnonzero(active)
+    if len(inds) == 3:
+        i, j, k = inds
+        nodes[i].branch_length = max(.5*(D[i,j] + D[i,k] - D[j,k]), 0)
+        nodes[j].branch_length = max(.5*(D[i,j] + D[j,k] - D[i,k]), 0)
+        nodes[k].branch_length = max(.5*(D[i,k] + D[j,k] - D[i,j]), 0)
+    else:
+        i, j = inds
+        nodes[i].branch_length = nodes[j].branch_length = .5*D[i,j]
+    return Tree(root=Clade(clades=[nodes[ind] for ind in inds]), rooted=False)
 
 
 #####
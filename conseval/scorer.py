@@ -1,7 +1,9 @@
 from __future__ import division
+import resource
 import time
+from conseval.io import get_params_fingerprint
 from conseval.params import ParamDef, Params, WithParams
-from conseval.utils.general import norm_scores, window_scores
+from conseval.utils.stats import norm_scores, window_scores
 
 
 ################################################################################
@@ -49,6 +51,10 @@ class Scorer(WithParams):
     method in scorers/[scorer_name.py] with class name ScorerName.
     """
 
+    # Whether _score uses alignment.get_phylotree().  Batch scoring runs
+    # scorers that don't first, while the tree is computed.
+    USES_TREE = False
+
     # Tunable parameters for scoring.  Children inherit all these parameters
     # along with these defaults.  Defaults can be overridden and parameters
     # can be extended, see scorers/rate4site_eb.py for an example.
@@ -65,6 +71,8 @@ class Scorer(WithParams):
     def __init__(self, **params):
         super(Scorer, self).__init__(**params)
         self.name = ".".join(type(self).__module__.split('.')[1:])
+        self.fingerprint = get_params_fingerprint(self)
+        self.metrics = None
 
 
     def score(self, alignment):
@@ -76,11 +84,18 @@ class Scorer(WithParams):
         Additional global computations can be performed by overriding _precache(),
         see below.
 
+        Sets self.metrics to a dict of measurements of this call: wall_time
+        and cpu_time in seconds, max_rss_delta, the increase in this process'
+        peak memory use in KB, and the scorer, its fingerprint (see
+        set_align_params), and the alignment's align_file, n_seqs and
+        n_sites.
+
         @param alignment:
             Alignment object
         @return:
             List of scores for each site
         """
+        usage0 = resource.getrusage(resource.RUSAGE_SELF)
         t0 = time.time()
 
         # Main computation.
@@ -91,7 +106,19 @@ class Scorer(WithParams):
         if self.normalize:
             scores = list(norm_scores(scores, filter=5))
 
-        dt = time.time() - t0 #len(alignment.msa), len(alignment.msa[0])
+        dt = time.time() - t0
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        n_seqs, n_sites = alignment.msa_array.shape
+        self.metrics = {
+            'scorer': self.name,
+            'fingerprint': self.fingerprint,
+            'align_file': getattr(alignment, 'align_file', None),
+            'n_seqs': n_seqs,
+            'n_sites': n_sites,
+            'wall_time': dt,
+            'cpu_time': usage.ru_utime + usage.ru_stime - usage0.ru_utime - usage0.ru_stime,
+            'max_rss_delta': usage.ru_maxrss - usage0.ru_maxrss,
+        }
         return scores
 
 
@@ -113,3 +140,10 @@ class Scorer(WithParams):
 
     def set_output_dir(self, out_dir):
         self.output_dir = out_dir
+
+    def set_align_params(self, align_params):
+        """
+        Set the params the scored alignments are loaded with, which are
+        part of the fingerprint (see get_params_fingerprint).
+        """
+        self.fingerprint = get_params_fingerprint(self, align_params)
@@ -0,0 +1,316 @@
+"""
+Storage for the scores of one batchscore run (i.e. one scorer id) on a
+dataset.  Rather than one text file per alignment, scores are stored as
+float64 arrays concatenated in a few binary files, with text index files
+mapping each alignment to the offset and length of its scores.  Missing
+scores (None) are stored as NaN.
+
+A store lives in a directory, holding:
+- scores-<timestamp>-<pid>.bin, scores.idx: the merged scores and their
+  index.  The index names the data file it refers to in its "# data:"
+  header, and is replaced atomically by merge(), so readers always see a
+  consistent pair.  Readers only use the data file named by the index; any
+  other scores-*.bin file is left over from an earlier or interrupted
+  merge, and is removed by the next merge.  The index header also records
+  when it was merged and, if known, the scorer, its fingerprint (see
+  Scorer.set_align_params) and params, see get_header().
+- shard-<host>-<pid>.bin/.idx: scores appended by each writing process
+  since the last merge.  Each process only appends to its own shard, so
+  concurrent workers don't need to coordinate.
+
+Index lines are "<key>\t<offset>\t<length>\t<timestamp>", where the
+timestamp is when the key's scores were written.  Indexes from older
+versions have no timestamp.
+- *.res: scores in the legacy text format, from older runs.  These are read
+  if an alignment isn't in the binary files.
+"""
+import fcntl
+import glob
+import json
+import numpy as np
+import os
+import socket
+
+from conseval.io import read_batchscores, write_batchscores
+from conseval.utils.general import atomic_write, get_timestamp
+
+
+INDEX_FILE = 'scores.idx'
+LEGACY_EXT = '.res'
+
+
+class ScoreStore(object):
+
+    def __init__(self, store_dir, scorer=None):
+        """
+        @param store_dir:
+            Directory of the store.  Must exist.
+        @param scorer:
+            Scorer whose scores are written, recorded in the index header by
+            merge().  If not given, merge() keeps the scorer recorded by the
+            last merge, if any.
+        """
+        self.store_dir = os.path.abspath(store_dir)
+        self.scorer = scorer
+        self._index = None
+        self._data = {}
+        self._shard_pid = None
+        self._shard_data = None
+        self._shard_index = None
+
+
+    ##########
+    # Reading
+    ##########
+
+    def keys(self):
+        """
+        Sorted keys of all scores in the store, including legacy files.
+        """
+        return sorted(self._get_index())
+
+    def has(self, key):
+        return key in self._get_index()
+
+    def written(self, key):
+        """
+        Timestamp (see get_timestamp) of when the scores for `key` were
+        written, or None if unknown, e.g. for legacy files.
+        """
+        entry = self._get_index()[key]
+        if entry[0] is None:
+            return None
+        return entry[3]
+
+    def get_header(self):
+        """
+        Dict of the merged index's header: 'data', the data file, 'merged',
+        the timestamp of the merge, and if recorded, 'scorer', the scorer's
+        name, 'fingerprint', its fingerprint, and 'params', a dict of its
+        params.  Empty if the store was never merged.
+        """
+        merged_index = os.path.join(self.store_dir, INDEX_FILE)
+        if not os.path.exists(merged_index):
+            return {}
+        return _read_index_header(merged_index)
+
+    def read(self, key):
+        """
+        Scores for `key`, as a list of floats or None for missing scores.
+        """
+        entry = self._get_index()[key]
+        if entry[0] is None:
+            return read_batchscores(entry[1])
+        return [None if np.isnan(x) else x for x in self.read_array(key).tolist()]
+
+    def read_array(self, key):
+        """
+        Scores for `key` as a float64 array, with NaN for missing scores.  For
+        binary entries, this is a read-only view of the memory-mapped file.
+        """
+        entry = self._get_index()[key]
+        if entry[0] is None:
+            return np.array([np.nan if x is None else x for x in read_batchscores(entry[1])])
+        fname, offset, length, _ = entry
+        if not length:
+            return np.zeros(0)
+        if fname not in self._data:
+            self._data[fname] = np.memmap(os.path.join(self.store_dir, fname),
+                    dtype='<f8', mode='r')
+        return self._data[fname][offset:offset+length]
+
+    def reload(self):
+        """
+        Forget the loaded index, to see scores written since it was loaded.
+        """
+        self._index = None
+        self._data = {}
+
+    def _get_index(self):
+        """
+        Dict mapping keys to (data file, offset, length, timestamp), or to
+        (None, legacy file) for legacy entries.  Later entries override earlier ones: shards
+        override the merged scores, which override legacy files.
+        """
+        if self._index is None:
+            index = {}
+            for fname in glob.glob(os.path.join(self.store_dir, '*' + LEGACY_EXT)):
+                index[os.path.basename(fname)[:-len(LEGACY_EXT)]] = (None, fname)
+            merged_index = os.path.join(self.store_dir, INDEX_FILE)
+            if os.path.exists(merged_index):
+                index.update(_read_index(merged_index))
+            for fname in sorted(glob.glob(os.path.join(self.store_dir, 'shard-*.idx'))):
+                index.update(_read_index(fname, fname[:-4] + '.bin'))
+            self._index = index
+        return self._index
+
+
+    ##########
+    # Writing
+    ##########
+
+    def write(self, key, scores):
+        """
+        Append `scores`, a list of floats or None, for `key` to this
+        process' shard.  The scores are flushed before their index entry is
+        written, so an entry is only ever visible once complete.
+        """
+        arr = np.array([np.nan if x is None else x for x in scores], dtype='<f8')
+        if arr.ndim != 1:
+            raise ValueError("Can only store one score per site")
+        if self._shard_pid != os.getpid():
+            # First write, or this process was forked from the one that
+            # opened the shard.
+            self._open_shard()
+        self._shard_data.seek(0, os.SEEK_END)
+        offset = self._shard_data.tell() // 8
+        self._shard_data.write(arr.tostring())
+        self._shard_data.flush()
+        timestamp = get_timestamp()
+        self._shard_index.write("%s\t%d\t%d\t%s\n" % (key, offset, len(arr), timestamp))
+        self._shard_index.flush()
+        if self._index is not None:
+            self._index[key] = (os.path.basename(self._shard_data.name), offset, len(arr),
+                    timestamp)
+
+    def _open_shard(self):
+        prefix = os.path.join(self.store_dir, "shard-%s-%d" % (socket.gethostname(), os.getpid()))
+        self._shard_pid = os.getpid()
+        self._shard_data = open(prefix + '.bin', 'ab')
+        self._shard_index = open(prefix + '.idx', 'a+')
+        # Terminate any line left partial by a crash.
+        self._shard_index.seek(0, os.SEEK_END)
+        if self._shard_index.tell():
+            self._shard_index.seek(-1, os.SEEK_END)
+            if self._shard_index.read(1) != '\n':
+                # Switching from reading to writing needs a seek in between.
+                self._shard_index.seek(0, os.SEEK_END)
+                self._shard_index.write('\n')
+        self._data = {}
+
+    def merge(self):
+        """
+        Merge the shards and the merged scores into a new merged data file,
+        scores-<timestamp>-<pid>.bin (with a counter appended if that name
+        is taken), point the index at it, and remove the shards and all
+        other merged data files.  The index header records the store's
+        scorer, see __init__.  Call only when no process is writing to the
+        store.  Legacy files are left alone.
+        """
+        with open(os.path.join(self.store_dir, '.lock'), 'w') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            self.reload()
+            index = self._get_index()
+            shards = glob.glob(os.path.join(self.store_dir, 'shard-*'))
+            if not shards:
+                return
+
+            data_file = "scores-%s-%d.bin" % (get_timestamp(), os.getpid())
+            i = 1
+            while os.path.exists(os.path.join(self.store_dir, data_file)):
+                # Merged twice in a second.
+                data_file = "scores-%s-%d-%d.bin" % (get_timestamp(), os.getpid(), i)
+                i += 1
+            lines = ["# data: %s" % data_file, "# merged: %s" % get_timestamp()]
+            if self.scorer is not None:
+                lines += ["# scorer: %s" % self.scorer.name,
+                        "# fingerprint: %s" % self.scorer.fingerprint,
+                        "# params: %s" % json.dumps(dict(self.scorer.get_params()),
+                            sort_keys=True, default=str)]
+            else:
+                header = self.get_header()
+                lines += ["# %s: %s" % (k, header[k] if k != 'params' else
+                            json.dumps(header[k], sort_keys=True))
+                        for k in ('scorer', 'fingerprint', 'params') if k in header]
+            offset = 0
+            with open(os.path.join(self.store_dir, data_file), 'wb') as f:
+                for key in sorted(index):
+                    if index[key][0] is None:
+                        continue
+                    arr = self.read_array(key)
+                    f.write(np.asarray(arr, dtype='<f8').tostring())
+                    lines.append("%s\t%d\t%d\t%s" % (key, offset, len(arr),
+                            index[key][3] or ''))
+                    offset += len(arr)
+                f.flush()
+                os.fsync(f.fileno())
+            atomic_write(os.path.join(self.store_dir, INDEX_FILE), "\n".join(lines) + "\n")
+
+            for fname in shards:
+                os.remove(fname)
+            if self._shard_pid is not None:
+                # Later writes go to a new shard.
+                self._shard_data.close()
+                self._shard_index.close()
+                self._shard_pid = None
+            for fname in glob.glob(os.path.join(self.store_dir, 'scores-*.bin')):
+                if os.path.basename(fname) != data_file:
+                    os.remove(fname)
+            self.reload()
+
+
+    ##########
+    # Export
+    ##########
+
+    def export_res(self, out_dir=None, keys=None):
+        """
+        Write scores in the legacy format, one <key>.res file per key, to
+        `out_dir` (by default the store's directory).  Existing files are
+        skipped.
+
+        @return:
+            number of files written
+        """
+        if out_dir is None:
+            out_dir = self.store_dir
+        count = 0
+        for key in (keys or self.keys()):
+            fname = os.path.join(out_dir, key + LEGACY_EXT)
+            if os.path.exists(fname):
+                continue
+            write_batchscores(fname, self.read(key))
+            count += 1
+        return count
+
+
+def _read_index(fname, data_file=None):
+    """
+    Read an index file, as a dict mapping keys to (data file, offset,
+    length, timestamp).  If `data_file` is not given, it is read from the
+    header.  The timestamp is None for entries of older indexes.
+    """
+    index = {}
+    with open(fname) as f:
+        for line in f:
+            if line.startswith('# data: '):
+                data_file = line.split(':', 1)[1].strip()
+                continue
+            if line.startswith('#') or not line.endswith('\n'):
+                continue
+            t = line.rstrip('\n').split('\t')
+            if len(t) == 3:
+                t.append(None)
+            elif len(t) != 4:
+                continue
+            index[t[0]] = (os.path.basename(data_file), int(t[1]), int(t[2]), t[3] or None)
+    return index
+
+
+def _read_index_header(fname):
+    """
+    Read the "# <name>: <value>" header lines of an index file, as a dict.
+    'params' is decoded from JSON.
+    """
+    header = {}
+    with open(fname) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if ':' not in line:
+                continue
+            k, v = line[1:].split(':', 1)
+            header[k.strip()] = v.strip()
+    if 'params' in header:
+        header['params'] = json.loads(header['params'])
+    return header
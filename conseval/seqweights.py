@@ -5,9 +5,11 @@ according to their similarity.
 Code by Tony Capra 2007.
 """
 from __future__ import division
+import numpy as np
 import os
 
-from conseval.utils.bio import amino_acids, aa_to_index
+from conseval.utils.bio import weighted_freq_counts, GAP_INDEX
+from conseval.utils.general import atomic_write
 
 
 #####
@@ -15,57 +17,110 @@ from conseval.utils.bio import amino_acids, aa_to_index
 #####
 
 def get_seq_weights(alignment):
-    weights_file = '.'.join(alignment.align_file.split('.')[:-1]) + '.weights'
-    seq_weights = read_seq_weights(weights_file)
-    if not seq_weights or len(seq_weights) != len(alignment.msa):
-        seq_weights = _compute_seq_weights(alignment.msa)
+    """
+    Get the sequence weights for `alignment`.  Weights are read from the
+    weights file next to the alignment file (see get_legacy_weights_file)
+    if it matches the alignment, or else from the cache (see
+    get_weights_file).  Otherwise they are computed and written to the
+    cache, so that later runs can reuse them.  The weights file next to the
+    alignment file may be user-supplied, so it is never written.
+    """
+    msa_hash = alignment.get_msa_hash()
+    n_seqs = len(alignment.msa_array)
+    # Weights files without a hash were not written by us, so only check
+    # that they have the right number of weights.
+    seq_weights, file_hash = read_seq_weights(get_legacy_weights_file(alignment),
+            with_hash=True)
+    if seq_weights and len(seq_weights) == n_seqs and file_hash in (None, msa_hash):
+        return seq_weights
+
+    weights_file = get_weights_file(alignment)
+    seq_weights, file_hash = read_seq_weights(weights_file, with_hash=True)
+    if not seq_weights or len(seq_weights) != n_seqs or file_hash != msa_hash:
+        seq_weights = compute_seq_weights(alignment.msa_array)
+        try:
+            write_seq_weights(weights_file, alignment.names, seq_weights, msa_hash)
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            pass
     return seq_weights
-        
 
-def read_seq_weights(fname):
+
+def get_weights_file(alignment):
+    """
+    Computed weights are cached in the alignment's cache_dir if set, and
+    next to the alignment file otherwise, named by the hash of the
+    alignment, like cached trees.
+    """
+    cache_dir = alignment.cache_dir or os.path.dirname(alignment.align_file)
+    return os.path.join(cache_dir, alignment.get_msa_hash() + '.weights')
+
+
+def get_legacy_weights_file(alignment):
+    """
+    Weights file named after the alignment file, as supplied by users or
+    cached by older versions.
+    """
+    return '.'.join(alignment.align_file.split('.')[:-1]) + '.weights'
+
+
+def read_seq_weights(fname, with_hash=False):
     """
     Read in a sequence weight file f and create sequence weight list.
     The weights are in the same order as the sequences each on a new line.
+
+    If `with_hash`, return (weights, msa_hash), where msa_hash is the hash of
+    the alignment recorded in the file by write_seq_weights, if any.
     """
-    if not os.path.exists(fname):
-        return None
-    seq_weights = []
-    with open(fname) as f:
-        for line in f:
-            l = line.split()
-            if line[0] != '#' and len(l) == 2:
-                seq_weights.append(float(l[1]))
+    seq_weights = None
+    msa_hash = None
+    if os.path.exists(fname):
+        seq_weights = []
+        with open(fname) as f:
+            for line in f:
+                l = line.split()
+                if line.startswith('# msa_hash:') and len(l) == 3:
+                    msa_hash = l[2]
+                elif line[0] != '#' and len(l) == 2:
+                    seq_weights.append(float(l[1]))
+    if with_hash:
+        return seq_weights, msa_hash
     return seq_weights
 
 
-def _compute_seq_weights(msa):
+def write_seq_weights(fname, names, seq_weights, msa_hash):
+    """
+    Write sequence weights in the format read by read_seq_weights, recording
+    `msa_hash` so that stale weights can be detected.
+    """
+    if os.path.dirname(fname) and not os.path.exists(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    lines = ["# msa_hash: %s" % msa_hash]
+    lines += ["%s\t%r" % (name, w) for name, w in zip(names, seq_weights)]
+    atomic_write(fname, "\n".join(lines) + "\n")
+
+
+def compute_seq_weights(msa_array):
     """
     Calculate the sequence weights using the Henikoff '94 method
-    for the given msa.
+    for the given msa, an array as returned by encode_msa.  Unlike
+    get_seq_weights, the weights are not cached.
     """
-    seq_weights = [0.] * len(msa)
-    # For each column
-    for i in xrange(len(msa[0])):
-        # Find the frequency q of amino acids across all sequences
-        freq_counts = [0] * len(amino_acids)
-        for j in xrange(len(msa)):
-            if msa[j][i] != '-':
-                freq_counts[aa_to_index[msa[j][i]]] += 1
-        # Find the number of nonzero q's, N
-        num_observed_types = 0
-        for fc in freq_counts:
-            if fc:
-                num_observed_types +=1
-        # Add 1 / (q_{seq} * N).  This seems kind of weird.
-        # 1 / q_{seq} favors sequences with rarer amino acids in the column
-        # 1 / N favors adjustments from sites with fewer differences in their column
-        for j in xrange(len(msa)):
-            if msa[j][i] != '-':
-                seq_weights[j] += 1. / (freq_counts[aa_to_index[msa[j][i]]] * \
-                                        num_observed_types)
-    for w in xrange(len(seq_weights)):
-        seq_weights[w] /= len(msa[0])
-    return seq_weights
+    n_seqs, n_sites = msa_array.shape
+    # Find the frequency q of amino acids across all sequences, for each column
+    freq_counts = weighted_freq_counts(msa_array, np.ones(n_seqs))
+    freq_counts[:,GAP_INDEX] = 0
+    # Find the number of nonzero q's, N, for each column
+    num_observed_types = np.sum(freq_counts > 0, axis=1)
+    # Add 1 / (q_{seq} * N).  This seems kind of weird.
+    # 1 / q_{seq} favors sequences with rarer amino acids in the column
+    # 1 / N favors adjustments from sites with fewer differences in their column
+    q_seq = freq_counts[np.arange(n_sites), msa_array]
+    is_aa = (msa_array != GAP_INDEX)
+    terms = np.zeros(msa_array.shape)
+    terms[is_aa] = 1. / (q_seq * num_observed_types)[is_aa]
+    seq_weights = np.sum(terms, axis=1) / n_sites
+    return list(seq_weights)
 
 
 #####
@@ -73,4 +128,4 @@ def _compute_seq_weights(msa):
 if __name__ == "__main__":
     import sys
     from alignment import Alignment
-    print get_seq_weights(sys.argv[1], Alignment(sys.argv[1]).msa)
+    print get_seq_weights(Alignment(sys.argv[1]))
@@ -0,0 +1,300 @@
+"""
+A long-running local server that scores alignments, so that scorers and
+their substitution models, matrices etc. are loaded once rather than on
+every run of score.py.  See `score.py --serve`.
+
+Clients connect to a Unix socket, and send requests as lines of JSON, e.g.
+    {"scorer": "rate4site_eb", "scorer_params": {}, "align_file": "/x.aln",
+     "align_params": {}}
+or, with the alignment file's contents rather than its path,
+    {"scorer": "rate4site_eb", "alignment": ">seq1\\nACD...\\n..."}
+Paths, in "align_file" and in params, should be absolute, as the server's
+working dir may differ from the client's; score_remote makes them so.
+The server answers each request with a line of JSON, in the order of the
+requests on the connection:
+    {"ok": true, "scores": [...], "output": "<score.py output>"}
+or {"ok": false, "error": "<traceback>"}.  A client may send any number of
+requests on a connection before reading the answers.
+
+Requests from all connections are scored in batches by one thread, which
+keeps a scorer instantiated for each distinct scorer and params, and scores
+an alignment file only once if it is requested repeatedly within a batch.
+
+This module only imports the standard library at the top, so that clients
+start quickly.
+"""
+import contextlib
+import json
+import os
+import shutil
+import socket
+import tempfile
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "conseval-score-%d.sock" % os.getuid())
+
+# Max number of requests scored in one batch.
+MAX_BATCH = 64
+
+
+class ServerUnavailable(IOError):
+    """
+    Raised by clients if no server is listening on the socket.
+    """
+
+
+
+@contextlib.contextmanager
+def open_alignment(align_file=None, text=None, **align_params):
+    """
+    Context manager giving the Alignment of `align_file`, or of `text`, the
+    contents of an alignment file.
+
+    An alignment given as `text` is written to a private temp dir, which
+    also receives the data cached next to the alignment file (sequence
+    weights, trees and their lock files), unless cache_dir is set.  The dir
+    is removed on leaving the context, so the alignment should only be
+    scored within it.
+    """
+    from conseval.alignment import Alignment
+    if text is None:
+        yield Alignment(align_file, **align_params)
+        return
+    tmp_dir = tempfile.mkdtemp(prefix='conseval-aln-')
+    try:
+        fname = os.path.join(tmp_dir, 'stdin.aln')
+        with open(fname, 'w') as f:
+            f.write(text)
+        yield Alignment(fname, **align_params)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _abspath_params(params):
+    """
+    Copy of `params` with relative paths made absolute: values of params
+    named *_file or *_dir, and values naming an existing file or dir.
+    """
+    res = {}
+    for k, v in params.items():
+        if isinstance(v, basestring) and v and not os.path.isabs(v) and \
+                (k.endswith('_file') or k.endswith('_dir') or os.path.exists(v)):
+            v = os.path.abspath(v)
+        res[k] = v
+    return res
+
+
+def _str_dict(d):
+    """
+    Params decoded from JSON, with str rather than unicode keys and values.
+    """
+    return dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v)
+            for k, v in d.items())
+
+
+
+################################################################################
+# Client
+################################################################################
+
+def score_remote(socket_path, scorer_name, align_file=None, alignment=None,
+        scorer_params={}, align_params={}):
+    """
+    Ask the server listening on `socket_path` to score an alignment, given
+    either as the path `align_file` or as the file contents `alignment`.
+    Returns the server's response, see the module docs.  Raises
+    ServerUnavailable if no server is listening.
+    """
+    request = dict(scorer=scorer_name, scorer_params=_abspath_params(scorer_params),
+            align_params=_abspath_params(align_params))
+    if align_file:
+        request['align_file'] = os.path.abspath(align_file)
+    else:
+        request['alignment'] = alignment
+    return score_remote_batch(socket_path, [request])[0]
+
+
+def score_remote_batch(socket_path, requests):
+    """
+    Send all `requests` on one connection to the server listening on
+    `socket_path`, and return the list of its responses.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error, e:
+        sock.close()
+        raise ServerUnavailable("No scoring server at %s: %s" % (socket_path, e))
+    try:
+        f = sock.makefile('rwb')
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+        f.flush()
+        sock.shutdown(socket.SHUT_WR)
+        responses = []
+        for _ in requests:
+            line = f.readline()
+            if not line:
+                raise IOError("Scoring server at %s closed the connection" % socket_path)
+            responses.append(json.loads(line))
+        return responses
+    finally:
+        sock.close()
+
+
+
+################################################################################
+# Server
+################################################################################
+
+class ScoreServer(object):
+
+    def __init__(self, write_scores, socket_path=DEFAULT_SOCKET, max_batch=MAX_BATCH):
+        """
+        @param write_scores:
+            Function writing scores as output, with the signature of
+            score.write_scores
+        @param socket_path:
+            Path of the Unix socket to listen on.  A stale socket file left
+            by a dead server is replaced.
+        @param max_batch:
+            Max number of requests to score in one batch
+        """
+        import Queue
+        self.write_scores = write_scores
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self._requests = Queue.Queue()
+        self._scorers = {}
+
+    def serve_forever(self):
+        """
+        Serve until killed, by Ctrl-C or SIGTERM, then remove the socket.
+        """
+        import signal
+        import sys
+        import threading
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if os.path.exists(self.socket_path):
+            try:
+                score_remote_batch(self.socket_path, [])
+            except ServerUnavailable:
+                os.remove(self.socket_path)
+            else:
+                raise IOError("A scoring server is already running at %s" % self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0077)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(128)
+        scorer_thread = threading.Thread(target=self._score_loop)
+        scorer_thread.daemon = True
+        scorer_thread.start()
+        try:
+            while True:
+                conn, _ = sock.accept()
+                t = threading.Thread(target=self._handle_connection, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            sock.close()
+            os.remove(self.socket_path)
+
+    def _handle_connection(self, conn):
+        """
+        Read requests from `conn` and queue them for scoring, while writing
+        the responses back in order as they are ready.
+        """
+        import Queue
+        import threading
+        pending = Queue.Queue()
+        def write_responses():
+            f_out = conn.makefile('wb')
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                done, response = item
+                done.wait()
+                try:
+                    f_out.write(json.dumps(response) + "\n")
+                    f_out.flush()
+                except socket.error:
+                    # The client went away.
+                    break
+        writer = threading.Thread(target=write_responses)
+        writer.start()
+        try:
+            for line in conn.makefile('rb'):
+                done = threading.Event()
+                response = {}
+                try:
+                    request = json.loads(line)
+                except ValueError, e:
+                    response.update(ok=False, error="Bad request: %s" % e)
+                    done.set()
+                else:
+                    self._requests.put((request, response, done))
+                pending.put((done, response))
+        finally:
+            pending.put(None)
+            writer.join()
+            conn.close()
+
+    def _score_loop(self):
+        """
+        Score queued requests in batches, forever.
+        """
+        import Queue
+        while True:
+            batch = [self._requests.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._requests.get_nowait())
+                except Queue.Empty:
+                    break
+            self._score_batch(batch)
+
+    def _score_batch(self, batch):
+        import traceback
+        done_by_key = {}
+        for request, response, done in batch:
+            try:
+                scorer = self._get_scorer(request['scorer'],
+                        _str_dict(request.get('scorer_params', {})))
+                align_params = _str_dict(request.get('align_params', {}))
+                with open_alignment(request.get('align_file'), request.get('alignment'),
+                        **align_params) as alignment:
+                    # The output names the alignment file, and files with
+                    # the same contents may differ in cached data next to
+                    # them, e.g. sequence weights.
+                    key = (id(scorer), request.get('align_file'), alignment.get_msa_hash(),
+                            tuple(sorted(align_params.items())))
+                    if key not in done_by_key:
+                        done_by_key[key] = self._score(scorer, alignment, request['scorer'])
+                response.update(done_by_key[key])
+            except Exception:
+                response.update(ok=False, error=traceback.format_exc())
+            done.set()
+
+    def _get_scorer(self, name, params):
+        """
+        Get the scorer for `name` and `params`, instantiating it only the
+        first time.
+        """
+        from conseval.scorer import get_scorer
+        key = (str(name), tuple(sorted(params.items())))
+        if key not in self._scorers:
+            self._scorers[key] = get_scorer(str(name), **params)
+        return self._scorers[key]
+
+    def _score(self, scorer, alignment, scorer_name):
+        from cStringIO import StringIO
+        from conseval.io import list_scorer_params
+        scores = scorer.score(alignment)
+        out = StringIO()
+        self.write_scores(alignment, [scores], [scorer_name],
+                header=list_scorer_params(scorer), f=out)
+        return dict(ok=True, scores=scores, output=out.getvalue())
@@ -0,0 +1,188 @@
+"""
+Simulation of alignments evolving along a phylogenetic tree under a
+substitution model, with a rate per site as in rate4site.
+"""
+from Bio.Phylo.BaseTree import Clade, Tree
+import numpy as np
+
+from conseval.alignment import MockAlignment
+from conseval.seqweights import compute_seq_weights
+from conseval.substitution import N_STATES
+from conseval.utils.bio import GAP_INDEX
+
+
+TREE_SHAPES = ('random', 'balanced', 'caterpillar')
+
+# Tolerance for the rows of P matrices summing to 1.
+PROB_TOLERANCE = 1e-4
+
+
+def simulate_msa(tree, names, rates, sub_model, n_runs=1, random_state=None):
+    """
+    Simulate `n_runs` alignments of the sequences at the leaves of `tree`.
+    At each site, a state is drawn at the root from the stationary
+    distribution of `sub_model`, and evolves down each branch of length t
+    according to P(rate * t) for the site's rate.
+
+    States are drawn for all runs and sites at once on each branch, by
+    inverse-CDF sampling on the branch's cumulative P matrices of all
+    distinct rates.  These are computed for one branch at a time as the tree
+    is traversed, rather than for all branches up front.
+
+    @param tree:
+        Bio.Phylo tree, whose leaves are named by `names`
+    @param names:
+        names of the sequences, in the order of the rows of the output
+    @param rates:
+        rate of each site; must be finite and non-negative
+    @param sub_model:
+        SubstitutionModel
+    @param n_runs:
+        number of alignments to simulate
+    @param random_state:
+        np.random.RandomState to draw from; by default, a new one
+    @return:
+        (n_runs x sequences x sites) uint8 array of indices into
+        amino_acids, so each run can be used as the msa_array of a
+        MockAlignment.  There are no gaps.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    rates = np.asarray(rates, dtype=float)
+    if not np.all(np.isfinite(rates)) or np.any(rates < 0):
+        raise ValueError("Rates must be finite and non-negative")
+    rates, site_rates = np.unique(rates, return_inverse=True)
+    n_sites = len(site_rates)
+    names_map = dict((name, i) for i, name in enumerate(names))
+
+    cum_root = np.cumsum(sub_model.freqs)
+    if abs(cum_root[-1] - 1) > PROB_TOLERANCE:
+        raise ValueError("Bad probability matrix")
+    # Guard against rounding, so every draw in [0,1) maps to a state.
+    cum_root[-1] = 1
+
+    out = np.empty((n_runs, len(names), n_sites), dtype=np.uint8)
+    root_states = np.searchsorted(cum_root,
+            random_state.random_sample((n_runs, n_sites)), side='right')
+    stack = [(node, root_states) for node in tree.root.clades]
+    while stack:
+        node, parent_states = stack.pop()
+        cum_Ps = _get_cum_Ps(sub_model, (node.branch_length or 0.) * rates)
+        # (runs x sites x N_STATES) CDFs of the node's state, given its
+        # parent's state and the site's rate.
+        cdfs = cum_Ps[site_rates[np.newaxis,:], parent_states]
+        u = random_state.random_sample((n_runs, n_sites))
+        states = np.minimum(np.sum(cdfs <= u[...,np.newaxis], axis=-1), N_STATES-1)
+        if node.is_terminal():
+            out[:,names_map[node.name],:] = states
+        else:
+            stack += ((child, states) for child in node.clades)
+    return out
+
+
+def _get_cum_Ps(sub_model, ts):
+    """
+    Cumulative P(t) matrices of `sub_model`, over the last axis, for each
+    of `ts`.  Raises ValueError if they are not valid probabilities.
+    """
+    Ps = sub_model.calc_P_batch(ts)
+    cum_Ps = np.cumsum(Ps, axis=-1)
+    if np.any(Ps < -PROB_TOLERANCE) or np.any(np.abs(cum_Ps[...,-1] - 1) > PROB_TOLERANCE) \
+            or not np.all(np.isfinite(cum_Ps)):
+        raise ValueError("Bad probability matrix")
+    # Guard against rounding, so every draw in [0,1) maps to a state.
+    cum_Ps[...,-1] = 1
+    return cum_Ps
+
+
+################################################################################
+# Synthetic alignments
+################################################################################
+
+def random_tree(names, shape='random', branch_length=.1, random_state=None):
+    """
+    Generate a rooted binary tree with leaves named by `names`.
+
+    @param shape:
+        'random' joins random pairs of subtrees, as in the coalescent;
+        'balanced' splits the leaves in halves recursively, giving the
+        shallowest tree; 'caterpillar' adds leaves one at a time, giving the
+        deepest tree.
+    @param branch_length:
+        mean branch length.  Branch lengths are exponentially distributed.
+    """
+    if shape not in TREE_SHAPES:
+        raise ValueError("Unknown tree shape %r, must be one of %s" % (shape, TREE_SHAPES))
+    if random_state is None:
+        random_state = np.random.RandomState()
+    def new_clade(clades=None, name=None):
+        return Clade(branch_length=random_state.exponential(branch_length),
+                name=name, clades=clades)
+
+    leaves = [new_clade(name=name) for name in names]
+    if shape == 'balanced':
+        def join(clades):
+            if len(clades) == 1:
+                return clades[0]
+            mid = len(clades) // 2
+            return new_clade([join(clades[:mid]), join(clades[mid:])])
+        root = join(leaves)
+    elif shape == 'caterpillar':
+        root = leaves[0]
+        for leaf in leaves[1:]:
+            root = new_clade([root, leaf])
+    else:
+        clades = list(leaves)
+        while len(clades) > 1:
+            i, j = sorted(random_state.choice(len(clades), 2, replace=False))
+            joined = new_clade([clades[i], clades[j]])
+            del clades[j]
+            clades[i] = joined
+        root = clades[0]
+    root.branch_length = None
+    return Tree(root=root, rooted=True)
+
+
+def gamma_rates(n_sites, alpha, random_state=None):
+    """
+    Draw a rate for each of `n_sites` sites from a gamma distribution with
+    shape `alpha` and mean 1.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    return random_state.gamma(alpha, 1. / alpha, n_sites)
+
+
+def simulate_alignment(n_seqs, n_sites, sub_model, alpha=1., tree_shape='random',
+        branch_length=.1, gap_fraction=0., random_state=None):
+    """
+    Simulate an alignment of `n_seqs` sequences of `n_sites` sites, evolving
+    under `sub_model` along a tree from random_tree, with rates drawn from
+    gamma_rates.
+
+    @param gap_fraction:
+        fraction of the residues in all but the first sequence replaced by
+        gaps, at random
+    @return:
+        MockAlignment, whose tree is the true tree and whose sequence weights
+        are computed on first use.  Its rates are set as `rates`.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    names = ["seq%d" % i for i in xrange(n_seqs)]
+    tree = random_tree(names, tree_shape, branch_length, random_state)
+    rates = gamma_rates(n_sites, alpha, random_state)
+    msa = simulate_msa(tree, names, rates, sub_model, 1, random_state)[0]
+    if gap_fraction:
+        is_gap = random_state.random_sample(msa.shape) < gap_fraction
+        is_gap[0] = False
+        msa[is_gap] = GAP_INDEX
+
+    seq_weights = []
+    def get_seq_weights():
+        if not seq_weights:
+            seq_weights.append(compute_seq_weights(alignment.msa_array))
+        return seq_weights[0]
+    alignment = MockAlignment(names, msa, tree, get_seq_weights)
+    alignment.rates = rates
+    return alignment
@@ -1,4 +1,5 @@
 from __future__ import division
+from collections import OrderedDict
 import numpy as np
 import os
 
@@ -9,6 +10,15 @@ from conseval.utils.bio import amino_acids
 N_STATES = 20
 PRECISION = .1**5
 
+# Times t are rounded to multiples of this before P(t) is computed and cached
+# in SubstitutionModel.calc_P_batch.
+T_QUANTUM = .1**8
+# Max number of P(t) matrices cached per SubstitutionModel.
+P_CACHE_SIZE = 10000
+# Max number of distinct P(t) matrices computed at once in calc_P_batch,
+# bounding its temporary memory.
+P_CHUNK_SIZE = 1024
+
 
 class SubstitutionModel(object):
     """
@@ -74,6 +84,10 @@ class SubstitutionModel(object):
         # Prepare multipliers for calc_P.  See calc_P docs for details.
         self.calc_P_left = PI_pow_neghalf * A_eigvecs
         self.calc_P_right = A_eigvecs.T * PI_pow_poshalf
+        # LRU cache for calc_P_batch, mapping quantized t to P(t).  This lives
+        # as long as the model, so it is shared by all alignments scored by
+        # the same scorer in a process.
+        self._P_cache = OrderedDict()
         # Verify that probability calculation is OK.
         P = self.calc_P()
         if np.any(np.abs(self.freqs*P - self.freqs) > PRECISION):
@@ -97,6 +111,62 @@ class SubstitutionModel(object):
         A_eigvals_exp = np.diag(np.exp(self.A_eigvals*t))
         return self.calc_P_left * A_eigvals_exp * self.calc_P_right
 
+    def calc_P_batch(self, ts):
+        """
+        Compute the probability matrices P(t) for every t in `ts` at once, as
+        in calc_P, and return them as a (len(ts) x N_STATES x N_STATES) array.
+
+        Each t is rounded to a multiple of T_QUANTUM, and P(t) is computed
+        once per distinct t.  The resulting P(t) are cached, so that the same
+        (rounded) t is only ever computed once as long as it stays among the
+        P_CACHE_SIZE most recently used.
+        """
+        keys = np.round(np.asarray(ts, dtype=float).reshape(-1) / T_QUANTUM).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        # Indices of keys grouped by unique key, and where each group starts.
+        order = np.argsort(inverse, kind='mergesort')
+        starts = np.concatenate(([0], np.cumsum(np.bincount(inverse))))
+
+        # Get the matrices of a chunk of unique keys at a time, and copy them
+        # to where their keys are, so that only Ps is allocated in full.
+        Ps = np.empty((len(keys), N_STATES, N_STATES))
+        for i in xrange(0, len(unique_keys), P_CHUNK_SIZE):
+            j = min(i + P_CHUNK_SIZE, len(unique_keys))
+            idx = order[starts[i]:starts[j]]
+            Ps[idx] = self._calc_P_keys(unique_keys[i:j])[inverse[idx] - i]
+        return Ps
+
+    def _calc_P_keys(self, keys):
+        """
+        calc_P_batch for distinct `keys`, the t quantized by T_QUANTUM.
+        """
+        Ps = np.empty((len(keys), N_STATES, N_STATES))
+        cache = self._P_cache
+
+        # Look up cached matrices; collect the rest to compute in one go.
+        missing = []
+        for i, key in enumerate(keys):
+            P = cache.pop(key, None)
+            if P is None:
+                missing.append(i)
+            else:
+                # Re-insert to mark as most recently used.
+                cache[key] = P
+                Ps[i] = P
+        if missing:
+            A_eigvals_exp = np.exp(np.outer(keys[missing] * T_QUANTUM, self.A_eigvals))
+            new_Ps = np.einsum('ik,nk,kj->nij', np.asarray(self.calc_P_left),
+                    A_eigvals_exp, np.asarray(self.calc_P_right))
+            # Entries that should be ~0, e.g. off the diagonal for small t,
+            # can come out slightly negative from rounding.
+            Ps[missing] = np.maximum(new_Ps, 0, out=new_Ps)
+            # Cache copies, so that cached matrices don't keep Ps alive.
+            for i in missing:
+                cache[keys[i]] = Ps[i].copy()
+            while len(cache) > P_CACHE_SIZE:
+                cache.popitem(last=False)
+        return Ps
+
 
 def read_sim_matrix(sm_file):
     """
@@ -127,7 +197,7 @@ def read_sim_matrix(sm_file):
         for i in range(0,19):
             for j in range(i+1, 20):
                 list_sm[i].append(list_sm[j][i])
-    return list_sm
+    return np.array(list_sm)
 
 
 def read_bg_distribution(fname):
@@ -7,6 +7,7 @@ iupac_alphabet = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "K", "L", "M", "N
 
 # dictionary to map from amino acid to its row/column in a similarity matrix
 aa_to_index = dict((aa,i) for i,aa in enumerate(amino_acids))
+GAP_INDEX = aa_to_index['-']
 
 
 def get_column(col_num, msa):
@@ -14,6 +15,51 @@ def get_column(col_num, msa):
     return [seq[col_num] for seq in msa]
 
 
+def get_column_patterns(msa_array):
+    """
+    Compress the columns of `msa_array` (see encode_msa) into its unique
+    column patterns.  Return (patterns, counts, site_patterns), where
+    `patterns` is a (sequences x patterns) array of the unique columns,
+    `counts[k]` is the number of sites whose column is `patterns[:,k]`, and
+    `site_patterns[i]` is the index into `patterns` of the `i`-th site's
+    column.
+    """
+    patterns, site_patterns, counts = np.unique(msa_array, axis=1,
+            return_inverse=True, return_counts=True)
+    return patterns, counts, site_patterns
+
+
+# Lookup table from the ASCII code of each amino acid to its index in
+# amino_acids.  Characters that aren't amino acids map to _NOT_AN_AA.
+_NOT_AN_AA = 255
+_ascii_to_index = np.zeros(256, dtype=np.uint8) + _NOT_AN_AA
+_ascii_to_index[[ord(aa) for aa in amino_acids]] = np.arange(len(amino_acids))
+
+
+def encode_msa(msa):
+    """
+    Return `msa`, a list of equal-length strings or lists of amino acids, as
+    a (sequences x sites) uint8 array of indices into `amino_acids`.  Gaps
+    are encoded as GAP_INDEX.  If `msa` is already an array, return it as is.
+    """
+    if isinstance(msa, np.ndarray):
+        return msa.astype(np.uint8, copy=False)
+    chars = np.frombuffer(''.join(''.join(seq) for seq in msa), dtype=np.uint8)
+    msa_array = _ascii_to_index[chars]
+    if np.any(msa_array == _NOT_AN_AA):
+        bad = set(chr(c) for c in chars[msa_array == _NOT_AN_AA])
+        raise ValueError("Unrecognized amino acids in alignment: %s" % ", ".join(sorted(bad)))
+    return msa_array.reshape(len(msa), -1)
+
+
+def decode_msa(msa_array):
+    """
+    Inverse of encode_msa.  Return `msa_array` as a list of lists of amino
+    acids.
+    """
+    return np.array(amino_acids)[msa_array].tolist()
+
+
 ################################################################################
 # Frequency Count and Gap Penalty
 ################################################################################
@@ -36,6 +82,45 @@ def weighted_freq_count_pseudocount(col, seq_weights, pc_amount, with_gap=True):
     return freq_counts
 
 
+def weighted_freq_counts(msa_array, seq_weights):
+    """
+    Return the weighted frequency counts of every column of `msa_array` (see
+    encode_msa) at once, as a (sites x len(amino_acids)) array.  No
+    pseudocount is added, and counts are not normalized.
+    """
+    n_seqs, n_sites = msa_array.shape
+    sz = len(amino_acids)
+    inds = msa_array + np.arange(n_sites) * sz
+    freq_counts = np.bincount(inds.reshape(-1), weights=np.repeat(seq_weights, n_sites),
+            minlength=n_sites*sz)
+    return freq_counts.reshape(n_sites, sz)
+
+
+def freq_counts_pseudocount(freq_counts, pc_amount, with_gap=True):
+    """
+    Like weighted_freq_count_pseudocount, but for every row of the
+    (sites x len(amino_acids)) array `freq_counts` returned by
+    weighted_freq_counts.
+    """
+    if not with_gap:
+        freq_counts = freq_counts[:,:GAP_INDEX]
+    freq_counts = freq_counts + pc_amount
+    return freq_counts / np.sum(freq_counts, axis=1)[:,np.newaxis]
+
+
+def partition_matrix(partition):
+    """
+    Return the (len(amino_acids) x len(partition)) 0/1 matrix mapping amino
+    acids to the groups in `partition`, a list of lists of amino acids.
+    Multiplying frequency counts by it sums them within each group.
+    """
+    mat = np.zeros((len(amino_acids), len(partition)))
+    for p, aas in enumerate(partition):
+        for aa in aas:
+            mat[aa_to_index[aa], p] = 1
+    return mat
+
+
 def weighted_gap_penalty(col, seq_weights):
     """
     Calculate the simple gap penalty multiplier for the column. If the
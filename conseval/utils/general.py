@@ -2,12 +2,32 @@ from bisect import bisect
 import datetime
 import os
 from random import random
+import tempfile
 
 
 def get_timestamp():
     return datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
 
+def atomic_write(fname, text):
+    """
+    Write `text` to `fname` atomically, by writing to a temporary file in the
+    same directory and renaming it.  Concurrent readers see either the old
+    file or the complete new one, never a partial write.
+    """
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp_fname, 0644)
+        os.rename(tmp_fname, fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+
 def get_all_module_names(dirname):
     dirname = os.path.abspath(dirname)
     names = []
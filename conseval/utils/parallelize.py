@@ -1,68 +1,277 @@
 import multiprocessing
+import os
+import select
 import signal
+import time
+import traceback
 
 
 ################################################################################
 # Simple parallelization
 ################################################################################
 
-# http://stackoverflow.com/q/8616630/
-# http://stackoverflow.com/a/16071616/
+class TaskError(Exception):
+    """
+    Returned by imap_unordered in place of the result of a call that raised
+    an exception or whose worker process died.  `tb` holds the traceback
+    from the worker process, if any.
+    """
+    def __init__(self, msg, tb=None):
+        Exception.__init__(self, msg)
+        self.tb = tb
 
-def _spawn(f):
-    def fun(q_in,q_out):
-        while True:
-            i,x = q_in.get()
-            if i == None:
-                break
-            q_out.put((i,f(x)))
-    return fun
+    def __str__(self):
+        if self.tb:
+            return "%s\n%s" % (self.message, self.tb)
+        return self.message
+
+
+class TaskTimeout(TaskError):
+    """
+    Returned by imap_unordered in place of the result of a call that ran
+    longer than the timeout.
+    """
+
+
+def _work(f, conn):
+    """
+    Worker process loop: receive (i, arg) on `conn`, send back (i, True,
+    f(arg)), or (i, False, traceback) if f raised.  Stops on receiving None.
+    """
+    # Leave Ctrl-C to the parent, which terminates the workers.  Run in a new
+    # process group, so that killing the worker also kills any subprocesses
+    # it started.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.setpgrp()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        i, arg = task
+        try:
+            msg = (i, True, f(arg))
+        except Exception:
+            msg = (i, False, traceback.format_exc())
+        try:
+            conn.send(msg)
+        except Exception:
+            # e.g. the result can't be pickled.
+            conn.send((i, False, traceback.format_exc()))
+    conn.close()
+
+
+class _Worker(object):
+    """
+    A worker process running _work, and the task it was last sent.
+    """
+    def __init__(self, f):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=_work, args=(f, child_conn))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        self.task = None
+        self.t_start = None
+        self.n_tasks = 0
+
+    def send(self, task):
+        self.conn.send(task)
+        self.task = task
+        self.t_start = time.time()
+        self.n_tasks += 1
+
+    def stop(self, kill=False):
+        if kill:
+            try:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+            except OSError:
+                # Already exited, or not yet in its own process group.
+                pass
+            self.proc.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                self.proc.terminate()
+        self.proc.join()
+        self.conn.close()
 
-def imap_unordered(f, args, nprocs=None, timeout=None):
+
+def imap_unordered(f, args, nprocs=None, timeout=None, max_tasks_per_child=None):
     """
-    Spawn `nprocs` processes to run `f` on the list of inputs in `args`.
+    Spawn `nprocs` processes to run `f` on the inputs in `args`.
     Returns an iterator on pairs (argument to f, results from f), returned
     in an arbitrary order.
 
-    If `timeout` is specified, then a pair (argument to f, None) may be
-    returned if the timeout is exceeded for any one run of the function.
+    If `f` raises an exception on an argument, or the process running it
+    dies, then the pair (argument to f, TaskError) is returned, and the dead
+    process is replaced.  If `timeout` is specified, the pair (argument to f,
+    TaskTimeout) is returned for any run of `f` that exceeds it, and the
+    process running it is killed and replaced.
+
+    Arguments are only taken from `args` as processes become free, so `args`
+    may be a generator.  If the caller stops iterating, or on Ctrl-C, all
+    processes are killed.
 
     @param f:
         Function to imap_unordered.  Must take 1 argument.
     @param args:
-        List of arguments to pass to `f`.
+        Iterable of arguments to pass to `f`.
+    @param nprocs:
+        Number of processes.  Defaults to the number of CPUs.
     @param timeout:
-        Maximum time to run `f` on any one input.
+        Maximum time in seconds to run `f` on any one input.
+    @param max_tasks_per_child:
+        If set, replace each process after it has run `f` this many times,
+        to free any memory it accumulated.
+    """
+    if not nprocs:
+        nprocs = multiprocessing.cpu_count()
+    args = iter(args)
+    inputs = {}
+    workers = [_Worker(f) for _ in xrange(nprocs)]
+    next_i = 0
+    try:
+        while True:
+            # Give every free worker a task.
+            for w in workers:
+                if w.task is None and args is not None:
+                    try:
+                        arg = next(args)
+                    except StopIteration:
+                        args = None
+                        break
+                    inputs[next_i] = arg
+                    w.send((next_i, arg))
+                    next_i += 1
+            busy = [w for w in workers if w.task is not None]
+            if not busy:
+                break
+
+            # Wait for results, waking up periodically to check for timeouts
+            # and dead workers.
+            wait = 1.
+            if timeout:
+                now = time.time()
+                wait = min(wait, max(0, min(w.t_start + timeout - now for w in busy)))
+            ready, _, _ = select.select([w.conn for w in busy], [], [], wait)
+
+            for w in busy:
+                i = w.task[0]
+                result = None
+                replace = False
+                if w.conn in ready:
+                    try:
+                        _, ok, res = w.conn.recv()
+                        result = res if ok else TaskError(
+                                "Error in worker process", res)
+                    except (EOFError, IOError):
+                        result = TaskError("Worker process died, exit code %s"
+                                % w.proc.exitcode)
+                        replace = True
+                elif not w.proc.is_alive():
+                    result = TaskError("Worker process died, exit code %s"
+                            % w.proc.exitcode)
+                    replace = True
+                elif timeout and time.time() - w.t_start > timeout:
+                    result = TaskTimeout("Timed out after %ss" % timeout)
+                    replace = True
+                else:
+                    continue
+                w.task = None
+                if replace or (max_tasks_per_child and w.n_tasks >= max_tasks_per_child):
+                    w.stop(kill=replace)
+                    workers[workers.index(w)] = _Worker(f)
+                yield (inputs.pop(i), result)
+    finally:
+        # Normal exit, an error, Ctrl-C, or the caller stopped iterating.
+        done = all(w.task is None for w in workers)
+        for w in workers:
+            w.stop(kill=not done)
+
+
+def imap(f, args, nprocs=None, read_ahead=None):
     """
-    q_in = multiprocessing.Queue()
-    q_out = multiprocessing.Queue()
+    Spawn `nprocs` processes to run `f` on the inputs in `args`.  Returns an
+    iterator on the results from f, in the order of `args`.
+
+    At most `read_ahead` results are computed ahead of the one the caller
+    is waiting for, so memory stays bounded even if one input is slow.  If
+    `f` raises an exception on an argument, or the process running it dies,
+    a TaskError is raised when its result would have been returned.  If the
+    caller stops iterating, or on Ctrl-C, all processes are killed.
 
+    @param f:
+        Function to imap.  Must take 1 argument.
+    @param args:
+        Iterable of arguments to pass to `f`.
+    @param nprocs:
+        Number of processes.  Defaults to the number of CPUs.
+    @param read_ahead:
+        Max number of results computed but not yet returned, or being
+        computed.  Defaults to 4 times `nprocs`.
+    """
     if not nprocs:
         nprocs = multiprocessing.cpu_count()
-    if timeout:
-        f = expire_after(timeout)(f)
-    procs = [multiprocessing.Process(target=_spawn(f), args=(q_in,q_out))
-            for _ in xrange(nprocs)]
-    for p in procs:
-        p.daemon = True
-        p.start()
-
-    tot = 0
-    for i,arg in enumerate(args):
-        q_in.put((i,arg))
-        #TODO: put only as many in as there are free workers
-        tot += 1
-    for _ in xrange(nprocs):
-        q_in.put((None,None))
-    q_in.close()
-
-    for _ in xrange(tot):
-        j, result = q_out.get()
-        yield (args[j], result)
-
-    # Just to make sure all child processes terminated?
-    for p in procs:
-        p.join()
+    if not read_ahead:
+        read_ahead = 4 * nprocs
+    args = iter(args)
+    results = {}
+    workers = [_Worker(f) for _ in xrange(nprocs)]
+    next_i = 0
+    next_yield = 0
+    try:
+        while True:
+            for w in workers:
+                if w.task is None and args is not None and next_i - next_yield < read_ahead:
+                    try:
+                        arg = next(args)
+                    except StopIteration:
+                        args = None
+                        break
+                    w.send((next_i, arg))
+                    next_i += 1
+
+            if next_yield in results:
+                ok, res = results.pop(next_yield)
+                if not ok:
+                    raise res
+                next_yield += 1
+                yield res
+                continue
+            busy = [w for w in workers if w.task is not None]
+            if not busy:
+                break
+
+            ready, _, _ = select.select([w.conn for w in busy], [], [], 1.)
+            for w in busy:
+                i = w.task[0]
+                if w.conn in ready:
+                    try:
+                        _, ok, res = w.conn.recv()
+                    except (EOFError, IOError):
+                        ok, res = False, None
+                    if not ok:
+                        res = TaskError("Error in worker process", res) if res \
+                                else TaskError("Worker process died, exit code %s"
+                                        % w.proc.exitcode)
+                elif not w.proc.is_alive():
+                    ok, res = False, TaskError("Worker process died, exit code %s"
+                            % w.proc.exitcode)
+                else:
+                    continue
+                w.task = None
+                results[i] = (ok, res)
+                if not w.proc.is_alive():
+                    w.stop(kill=True)
+                    workers[workers.index(w)] = _Worker(f)
+    finally:
+        done = all(w.task is None for w in workers)
+        for w in workers:
+            w.stop(kill=not done)
 
 
 ################################################################################
@@ -106,9 +315,16 @@ if __name__ == '__main__':
     for arg, res in imap_unordered(lambda i:i*2, [1,2,3,4,6,7,8]):
         print arg, res
     print ""
-    import time, os
     def test(x):
         time.sleep(x)
+        if x == 2:
+            raise ValueError(x)
+        if x == 3:
+            os._exit(1)
         return os.getpid()
-    for arg, res in imap_unordered(test, [1,2,3,6,7,8], nprocs=2, timeout=5):
+    for arg, res in imap_unordered(test, [1,2,3,6,7,8], nprocs=2, timeout=5,
+            max_tasks_per_child=2):
         print arg, res
+    print ""
+    print list(imap(lambda i: (time.sleep(.1*(i%3)), i)[1], xrange(20), nprocs=3,
+            read_ahead=5))
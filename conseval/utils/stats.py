@@ -5,40 +5,229 @@ import numpy as np
 # Score adjustments
 ################################################################################
 
+# The functions below take either a list of scores, in which missing scores
+# are None, or a 1-D or 2-D array of scores, in which missing scores are NaN.
+# In a 2-D array, each row is a separate track of scores, adjusted
+# independently of the others.  Lists are returned as lists, and arrays as
+# arrays.
+
+def _to_array(scores):
+    if isinstance(scores, np.ndarray):
+        return np.asarray(scores, dtype=float)
+    return np.array([np.nan if s is None else s for s in scores], dtype=float)
+
+
+def _to_list(arr):
+    return [None if np.isnan(s) else s for s in arr.tolist()]
+
+
 def norm_scores(x, filter=0):
-    x = np.array(x)
-    avg = np.mean(x)
-    stdev = np.std(x)
-    if not stdev:
-        return x
-    z_scores = (x - avg) / stdev
+    """
+    Convert each track of scores to z-scores, ignoring missing scores.  Tracks
+    with no variance are returned unchanged.  If `filter` is set, z-scores
+    with an absolute value higher than `filter` are set to `filter`.
+    """
+    arr = _to_array(x)
+    is_valid = ~np.isnan(arr)
+    if arr.ndim == 1 and np.all(is_valid):
+        avg = np.mean(arr)
+        stdev = np.std(arr)
+    else:
+        avg = np.nanmean(arr, axis=-1)[...,np.newaxis]
+        stdev = np.nanstd(arr, axis=-1)[...,np.newaxis]
+    is_const = (stdev == 0)
+    z_scores = np.where(is_const, arr, (arr - avg) / np.where(is_const, 1, stdev))
     if filter:
-        for i in xrange(len(z_scores)):
-            if abs(z_scores[i]) > filter:
-                z_scores[i] = filter
-    return z_scores
+        with np.errstate(invalid='ignore'):
+            is_filtered = (np.abs(z_scores) > filter) & ~is_const
+        z_scores[is_filtered] = filter
+    if isinstance(x, np.ndarray):
+        return z_scores
+    return _to_list(z_scores)
 
 
 def window_scores(scores, window_size, lam=.5):
     """
     This function takes a list of scores and a length and transforms them
     so that each position is a weighted average of the surrounding positions.
-    Positions with scores less than zero are not changed and are ignored in the
-    calculation. Here window_size is interpreted to mean window_size residues on
-    either side of the current residue.
-    
+    Missing scores are not changed and are ignored in the calculation. Here
+    window_size is interpreted to mean window_size residues on either side of
+    the current residue.  The window_size positions at either edge are not
+    changed.  The window sums are computed as a masked convolution, adding
+    the neighbors in the same order as the original per-position loop so
+    that results are identical.
+
     Code by Tony Capra 2007.
     """
-    w_scores = scores[:]
-    for i in xrange(window_size, len(scores)-window_size):
-        if scores[i] is None:
-            continue
-        curr_sum = 0.
-        num_terms = 0
-        for j in xrange(i-window_size, i+window_size+1):
-            if i != j and scores[j] is not None:
-                curr_sum += scores[j]
-                num_terms += 1
-        if num_terms:
-            w_scores[i] = (1-lam) * (curr_sum/num_terms) + lam * scores[i]
-    return w_scores
+    arr = _to_array(scores)
+    n = arr.shape[-1]
+    lo, hi = window_size, n - window_size
+    if hi <= lo:
+        if isinstance(scores, np.ndarray):
+            return arr.copy()
+        return list(scores)
+
+    is_valid = ~np.isnan(arr)
+    vals = np.where(is_valid, arr, 0.)
+    curr_sum = np.zeros(arr.shape[:-1] + (hi-lo,))
+    num_terms = np.zeros(curr_sum.shape, dtype=int)
+    for d in xrange(-window_size, window_size+1):
+        if d:
+            curr_sum += vals[...,lo+d:hi+d]
+            num_terms += is_valid[...,lo+d:hi+d]
+
+    is_changed = is_valid[...,lo:hi] & (num_terms > 0)
+    w_scores = (1-lam) * (curr_sum / np.maximum(num_terms, 1)) + lam * vals[...,lo:hi]
+
+    if isinstance(scores, np.ndarray):
+        out = arr.copy()
+        out[...,lo:hi][is_changed] = w_scores[is_changed]
+        return out
+    out = list(scores)
+    for i in np.flatnonzero(is_changed):
+        out[lo+i] = float(w_scores[i])
+    return out
+
+
+################################################################################
+# Classification curves
+################################################################################
+
+DEFAULT_QUANTUM = .0001
+
+# Key of sites without a score, which rank below all scored sites.
+MISSING_KEY = np.iinfo(np.int64).min
+
+
+class ScoreCounts(object):
+    """
+    Numbers of positive and negative sites with each distinct score, with
+    scores rounded to multiples of a quantum.  Counts from different
+    alignments, e.g. computed in different processes, can be merged, and
+    give exactly the curves of all their sites together.
+    """
+
+    # Merge pending counts once they have at least this many entries.
+    MIN_PENDING = 100000
+
+    def __init__(self, keys=None, n_pos=None, n_neg=None):
+        """
+        @param keys:
+            Sorted array of distinct rounded scores, as integer multiples of
+            the quantum.
+        @param n_pos, n_neg:
+            Arrays of the number of positive and negative sites at each key.
+        """
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else keys
+        self.n_pos = np.zeros(0, dtype=np.int64) if n_pos is None else n_pos
+        self.n_neg = np.zeros(0, dtype=np.int64) if n_neg is None else n_neg
+        self._pending = []
+        self._n_pending = 0
+
+    @classmethod
+    def from_scores(cls, scores, labels, quantum=DEFAULT_QUANTUM):
+        """
+        Counts of the sites with `scores` and `labels`.  Sites labeled None
+        are skipped; sites scored None rank below all others.
+        """
+        keys = []
+        is_pos = []
+        for score, label in zip(scores, labels):
+            if label is None:
+                continue
+            keys.append(MISSING_KEY if score is None else int(round(score / quantum)))
+            is_pos.append(bool(label))
+        return cls(*_count_keys(np.array(keys, dtype=np.int64), np.array(is_pos, dtype=bool)))
+
+    def merge(self, other):
+        """
+        Add the counts of `other` to these.
+        """
+        self._pending.append((other.keys, other.n_pos, other.n_neg))
+        self._pending += other._pending
+        self._n_pending += len(other.keys) + other._n_pending
+        if self._n_pending >= max(self.MIN_PENDING, len(self.keys)):
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        keys, n_pos, n_neg = zip(*([(self.keys, self.n_pos, self.n_neg)] + self._pending))
+        keys, inv = np.unique(np.concatenate(keys), return_inverse=True)
+        self.keys = keys
+        self.n_pos = np.bincount(inv, np.concatenate(n_pos), len(keys)).astype(np.int64)
+        self.n_neg = np.bincount(inv, np.concatenate(n_neg), len(keys)).astype(np.int64)
+        self._pending = []
+        self._n_pending = 0
+
+    def totals(self):
+        """
+        Total numbers of positive and negative sites.
+        """
+        self._flush()
+        return int(np.sum(self.n_pos)), int(np.sum(self.n_neg))
+
+    def curves(self):
+        """
+        ROC and PR curves, thresholding at every distinct score.  See
+        count_curves.
+        """
+        self._flush()
+        return count_curves(self.n_pos, self.n_neg)
+
+
+def _count_keys(keys, is_pos):
+    keys, inv = np.unique(keys, return_inverse=True)
+    n_pos = np.bincount(inv, is_pos, len(keys)).astype(np.int64)
+    n_neg = np.bincount(inv, ~is_pos, len(keys)).astype(np.int64)
+    return keys, n_pos, n_neg
+
+
+def count_curves(n_pos, n_neg):
+    """
+    ROC and PR curves from the numbers of positive and negative sites at
+    each distinct score, in order of increasing score.  `n_pos` and `n_neg`
+    may be 2-D arrays, e.g. of weighted counts, with the curves of each row
+    computed independently.
+
+    @return:
+        (fprs, tprs, precisions, recalls), arrays in order of decreasing
+        threshold along the last axis.  The ROC curve starts at (0,0).  The
+        PR curve starts at recall 0, with the precision at the highest
+        threshold.
+    """
+    tps = np.cumsum(np.asarray(n_pos, dtype=float)[...,::-1], axis=-1)
+    fps = np.cumsum(np.asarray(n_neg, dtype=float)[...,::-1], axis=-1)
+    zeros = np.zeros(tps.shape[:-1] + (1,))
+    if not tps.shape[-1]:
+        return zeros, zeros, zeros, zeros
+    n_pos_tot = np.maximum(tps[...,-1:], 1)
+    n_neg_tot = np.maximum(fps[...,-1:], 1)
+    fprs = np.concatenate((zeros, fps / n_neg_tot), axis=-1)
+    tprs = np.concatenate((zeros, tps / n_pos_tot), axis=-1)
+    # Above the highest score with a nonzero count (e.g. weight), precision
+    # is undefined; use the precision there.
+    n_called = tps + fps
+    precisions = tps / np.maximum(n_called, 1)
+    first = np.argmax(n_called > 0, axis=-1)[...,np.newaxis]
+    precisions = np.where(n_called > 0, precisions,
+            np.take_along_axis(precisions, first, axis=-1))
+    precisions = np.concatenate((precisions[...,:1], precisions), axis=-1)
+    return fprs, tprs, precisions, tprs
+
+
+def partial_auc(xs, ys, x_max):
+    """
+    Area under the piecewise linear curve through (`xs`, `ys`), for x up
+    to `x_max`.  `xs` must be non-decreasing along the last axis.  For 2-D
+    arrays, returns the area under the curve of each row.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    x0, x1 = xs[...,:-1], xs[...,1:]
+    y0, y1 = ys[...,:-1], ys[...,1:]
+    # Clip each segment at x_max.
+    x1_clip = np.clip(x1, x0, np.maximum(x0, x_max))
+    dx = x1 - x0
+    y1_clip = y0 + (y1 - y0) * (x1_clip - x0) / np.where(dx > 0, dx, 1)
+    return np.sum((x1_clip - x0) * (y0 + y1_clip) / 2, axis=-1)
@@ -1,14 +1,19 @@
 #!/usr/bin/python
 import argparse
+import cPickle
+import hashlib
 import imp
+import numpy as np
 import os
 import sys
 
 from conseval.alignment import Alignment
 from conseval.datasets import DATASET_CONFIGS
-from conseval.io import read_batchscores, parse_params, OUTPUT_DIR
-from conseval.utils.bio import get_column
-from conseval.utils.general import get_timestamp
+from conseval.io import parse_params, read_align_params, OUTPUT_DIR
+from conseval.scorestore import ScoreStore
+from conseval.utils import parallelize
+from conseval.utils.bio import GAP_INDEX
+from conseval.utils.general import atomic_write, get_timestamp
 
 
 
@@ -20,46 +25,52 @@ def get_batchscore_dir(dataset_name):
     return os.path.join(OUTPUT_DIR, "batchscore-%s" % dataset_name)
 
 
-def get_batchscores(dataset_name, batchscore_ids=[], align_files_only=False):
+def get_batchscores(dataset_name, batchscore_ids=[], align_files_only=False,
+        procs=1, fn=None, align_params=None):
     """
     Useful for evaluators.
     Get an iterator on (alignment, scores_col) where scores_col consists
     of lists of scores for each id in `batchscore_ids`.  This iterator is over
-    all alignments in `dataset_name`.
+    all alignments in `dataset_name`.  `alignment` is an EvalAlignment, so
+    alignments are not parsed unless their MSA is used.
+
+    Alignments are loaded with `align_params`, by default those the
+    batchscore runs were scored with (see get_run_align_params).
+
+    If `procs` is not 1, alignments and scores are loaded ahead in `procs`
+    processes (by default, the number of CPUs), still in the same order.
+    If `fn` is given, fn(alignment, scores_col) is yielded instead, computed
+    in those processes, e.g. to reduce each alignment's scores to a small
+    partial result.
     """
     # Sanity check.
     ds_dir = get_batchscore_dir(dataset_name)
     if not os.path.exists(ds_dir):
         raise IOError("%s for dataset %r does not exist"
                 % (ds_dir, dataset_name))
+    stores = []
     for batchscore_id in batchscore_ids:
         sc_dir = os.path.join(ds_dir, batchscore_id)
         if not os.path.exists(sc_dir):
             raise IOError("%s for dataset %r, scorer %r does not exist"
                     % (sc_dir, dataset_name, batchscore_id))
+        stores.append(ScoreStore(sc_dir))
+    if align_params is None:
+        align_params = get_run_align_params(dataset_name, batchscore_ids)
 
     dataset_config = DATASET_CONFIGS[dataset_name]
     align_files = dataset_config.get_align_files()
+    manifest = get_eval_manifest(dataset_name, procs, align_params)
 
     # Be particular about which alignments we can evaluate.
     afs = []
     for align_file in align_files:
-        alignment = Alignment(align_file)
-        n_gapped_cols = 0
-        for i in xrange(len(alignment.msa[0])):
-            col = get_column(i, alignment.msa)
-            if col.count('-') > len(col) / 2:
-                n_gapped_cols += 1
-        if n_gapped_cols > len(alignment.msa[0]) / 2:
+        entry = manifest[align_file]
+        n_seqs, n_sites = entry['shape']
+        if entry['n_gapped_cols'] > n_sites / 2:
             continue
-        include = True
-        for batchscore_id in batchscore_ids:
-            sc_dir = os.path.join(ds_dir, batchscore_id)
-            out_file = dataset_config.get_out_file(align_file, sc_dir)
-            if not os.path.exists(out_file):
-                include = False
-                break
-        if include:
+        out_name = dataset_config.get_out_name(align_file)
+        if all(store.has(out_name) for store in stores):
             afs.append(align_file)
 
     print "Evaluating dataset %r: %d/%d scored alignments after minor filtering" \
@@ -69,18 +80,189 @@ def get_batchscores(dataset_name, batchscore_ids=[], align_files_only=False):
             yield af
         return
 
-    # Iterate through score files in dataset, per alignment.
-    for align_file in afs:
-        scores_cols = []
-        for batchscore_id in batchscore_ids:
-            sc_dir = os.path.join(ds_dir, batchscore_id)
-            out_file = dataset_config.get_out_file(align_file, sc_dir)
-            scores = read_batchscores(out_file)
-            scores_cols.append(scores)
+    # Iterate through scores in dataset, per alignment.
+    def load(align_file):
+        out_name = dataset_config.get_out_name(align_file)
+        scores_cols = [store.read(out_name) for store in stores]
+        alignment = EvalAlignment(align_file, manifest[align_file],
+                test_file=dataset_config.get_test_file(align_file),
+                parse_testset_fn=dataset_config.parse_testset_fn, **align_params)
+        if alignment.testset is not None:
+            for batchscore_id, scores in zip(batchscore_ids, scores_cols):
+                if len(scores) != len(alignment.testset):
+                    raise ValueError("%s has %d scores from %s, but %d test labels"
+                            % (align_file, len(scores), batchscore_id, len(alignment.testset)))
+        if fn:
+            return fn(alignment, scores_cols)
+        return alignment, scores_cols
+    if procs == 1 or len(afs) <= 1:
+        for align_file in afs:
+            yield load(align_file)
+    else:
+        for res in parallelize.imap(load, afs, nprocs=procs):
+            yield res
+
+
+def get_run_align_params(dataset_name, batchscore_ids):
+    """
+    Get the alignment params that the batchscore runs `batchscore_ids` on
+    `dataset_name` were scored with, as recorded in their .params files.
+    Runs from before these were recorded are assumed to use the defaults.
+    Raises ValueError if the runs kept different sites of the alignments,
+    as their scores can't be compared.
+    """
+    ds_dir = get_batchscore_dir(dataset_name)
+    res = None
+    for batchscore_id in batchscore_ids:
+        params_file = os.path.join(ds_dir, "%s.params" % batchscore_id)
+        align_params = None
+        if os.path.exists(params_file):
+            align_params = read_align_params(params_file)
+        align_params = dict((str(k), v) for k, v in (align_params or {}).items())
+        if res is None:
+            res = align_params
+        elif get_manifest_key(align_params) != get_manifest_key(res):
+            raise ValueError("Batchscore runs %s were scored on alignments loaded with different params: %r, %r"
+                    % (", ".join(batchscore_ids), res, align_params))
+    return res or {}
+
+
+################################################################################
+# Evaluation manifest
+################################################################################
+
+# Bump when the manifest entries, or how Alignment filters an alignment,
+# change.
+MANIFEST_VERSION = 2
+
+# Alignment params that change which sequences and sites are kept, and so
+# the manifest entries.
+MANIFEST_ALIGN_PARAMS = ('max_sequences',)
+
+
+def get_manifest_key(align_params):
+    """
+    Key of the manifest entries for alignments loaded with `align_params`:
+    the cleaned values of MANIFEST_ALIGN_PARAMS, defaults included.
+    """
+    param_defs = dict((pd.name, pd) for pd in Alignment.params.param_defs)
+    key = []
+    for name in MANIFEST_ALIGN_PARAMS:
+        if name in align_params:
+            key.append((name, param_defs[name].clean(align_params[name])))
+        else:
+            key.append((name, param_defs[name].clean()))
+    return tuple(key)
+
+
+class EvalAlignment(object):
+    """
+    What evaluators need of an alignment, as read from the evaluation
+    manifest: `align_file`, `testset`, `shape` (the shape of the filtered
+    msa_array) and `orig_num_sequences`.  The alignment itself is only
+    parsed if `msa_array` or other Alignment attributes are accessed.
+    """
+    def __init__(self, align_file, entry, **align_params):
+        self.align_file = align_file
+        self.testset = entry['testset']
+        self.shape = entry['shape']
+        self.orig_num_sequences = entry['orig_num_sequences']
+        self._align_params = align_params
+        self._alignment = None
+
+    def get_alignment(self):
+        if self._alignment is None:
+            self._alignment = Alignment(self.align_file, **self._align_params)
+        return self._alignment
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get_alignment(), name)
+
+
+def get_eval_manifest(dataset_name, procs=1, align_params={}):
+    """
+    Get the evaluation manifest of `dataset_name`: a dict mapping each of
+    its alignment files to a dict of the filtered alignment's shape, its
+    number of gapped columns, its original number of sequences, and its
+    test labels, for alignments loaded with `align_params`.
+
+    The manifest is stored in the dataset's batchscore dir, so alignments
+    are parsed only once, rather than on every evaluation.  It holds
+    separate entries per get_manifest_key(align_params).  An entry is
+    recomputed if its alignment or test file changed, i.e. if their mtimes
+    or sizes changed and so did their contents.  If `procs` is not 1, new
+    entries are computed in `procs` processes.
+    """
+    dataset_config = DATASET_CONFIGS[dataset_name]
+    manifest_file = os.path.join(get_batchscore_dir(dataset_name), 'manifest.pkl')
+    key = get_manifest_key(align_params)
+    manifests = {}
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, 'rb') as f:
+                version, manifests = cPickle.load(f)
+            if version != MANIFEST_VERSION:
+                manifests = {}
+        except Exception:
+            manifests = {}
+    manifest = manifests.get(key, {})
+
+    changed = False
+    res = {}
+    stale = []
+    for align_file in dataset_config.get_align_files():
+        test_file = dataset_config.get_test_file(align_file)
+        entry = manifest.get(align_file)
+        files = [_get_file_state(fname, entry and entry['files'][i])
+                for i, fname in enumerate((align_file, test_file))]
+        if entry is None or [h for _, h in files] != [h for _, h in entry['files']]:
+            stale.append(align_file)
+            entry = {}
+        if entry.get('files') != files:
+            entry['files'] = files
+            changed = True
+        res[align_file] = entry
+
+    # Parse the new or changed alignments.
+    def make_entry(align_file):
         alignment = Alignment(align_file,
                 test_file=dataset_config.get_test_file(align_file),
-                parse_testset_fn=dataset_config.parse_testset_fn)
-        yield alignment, scores_cols
+                parse_testset_fn=dataset_config.parse_testset_fn, **dict(key))
+        n_seqs, n_sites = alignment.msa_array.shape
+        n_gaps = np.sum(alignment.msa_array == GAP_INDEX, axis=0)
+        return {
+            'shape': (n_seqs, n_sites),
+            'n_gapped_cols': int(np.sum(n_gaps > n_seqs / 2)),
+            'orig_num_sequences': alignment.orig_num_sequences,
+            'testset': alignment.testset,
+        }
+    if procs == 1 or len(stale) <= 1:
+        entries = (make_entry(af) for af in stale)
+    else:
+        entries = parallelize.imap(make_entry, stale, nprocs=procs)
+    for align_file, entry in zip(stale, entries):
+        res[align_file].update(entry)
+
+    if changed or len(res) != len(manifest):
+        manifests[key] = res
+        atomic_write(manifest_file, cPickle.dumps(
+            (MANIFEST_VERSION, manifests), cPickle.HIGHEST_PROTOCOL))
+    return res
+
+
+def _get_file_state(fname, old_state=None):
+    """
+    Return ((mtime, size), sha1 of contents) of `fname`.  The contents are
+    only hashed if the mtime or size differ from those in `old_state`.
+    """
+    st = os.stat(fname)
+    stamp = (st.st_mtime, st.st_size)
+    if old_state and old_state[0] == stamp:
+        return old_state
+    with open(fname, 'rb') as f:
+        return stamp, hashlib.sha1(f.read()).hexdigest()
 
 
 
@@ -1,7 +1,7 @@
 import os
 import sys
 from conseval.datasets import DATASET_CONFIGS
-from conseval.io import read_batchscores, write_batchscores
+from conseval.scorestore import ScoreStore
 from conseval.utils.stats import norm_scores, window_scores
 from evaluate import get_batchscore_dir
 
@@ -47,12 +47,14 @@ def adjust_scores(dataset_name, *batchscore_ids, **kwargs):
             for fname in os.listdir(sc_dir_adj):
                 os.remove(os.path.join(sc_dir_adj, fname))
 
+        store = ScoreStore(sc_dir)
+        store_adj = ScoreStore(sc_dir_adj)
         align_files = dc.get_align_files()
         for align_file in align_files:
-            out_file = dc.get_out_file(align_file, sc_dir)
-            if not os.path.exists(out_file):
+            out_name = dc.get_out_name(align_file)
+            if not store.has(out_name):
                 continue
-            scores = read_batchscores(out_file)
+            scores = store.read(out_name)
 
             if adj_type is 'norm':
                 scores_adj = norm_scores(scores, filter=5)
@@ -61,7 +63,7 @@ def adjust_scores(dataset_name, *batchscore_ids, **kwargs):
             elif adj_type.startswith('window'):
                 scores_adj = window_scores(scores, window_size)
 
-            out_file_adj = os.path.join(sc_dir_adj, os.path.split(out_file)[-1])
-            write_batchscores(out_file_adj, scores_adj)
+            store_adj.write(out_name, scores_adj)
 
+        store_adj.merge()
         print "Created %s" % sc_dir_adj
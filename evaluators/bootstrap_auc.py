@@ -0,0 +1,154 @@
+from __future__ import division
+import itertools
+import multiprocessing
+import numpy as np
+import os
+import scipy.sparse
+
+from conseval.utils import parallelize
+from conseval.utils.general import get_timestamp
+from conseval.utils.stats import ScoreCounts, count_curves, partial_auc, DEFAULT_QUANTUM
+from evaluate import get_batchscores, get_batchscore_dir
+
+
+AUC_LEVELS = [.1, .5, 1]
+CURVES = ("PR", "ROC")
+
+# Max number of (replicate, distinct score) cells computed at once.
+MAX_CELLS = 2000000
+
+
+def bootstrap_auc(dataset_name, *batchscore_ids, **kwargs):
+    """
+    Bootstrap confidence intervals for the PR and ROC AUCs up to each of
+    AUC_LEVELS of each scorer, and for the differences between the AUCs of
+    each pair of scorers, with p-values for the differences.  Alignments,
+    not sites, are resampled, as sites in an alignment are not independent.
+    Results are printed and written to a tab-separated results file.
+
+    Optional kwargs:
+        n_boot: number of bootstrap replicates (default 1000).
+        alpha: CIs are 1-alpha (default .05).
+        procs: number of processes (default 0, for the number of CPUs).
+        quantum: scores are rounded to multiples of this (default .0001,
+            see pr_roc).
+        seed: random seed (default 0).
+        out: results file (default bootstrap_auc-<timestamp>.txt in the
+            dataset's batchscore dir).
+    """
+    n_boot = int(kwargs.get('n_boot', 1000))
+    alpha = float(kwargs.get('alpha', .05))
+    procs = int(kwargs.get('procs', 0)) or multiprocessing.cpu_count()
+    quantum = float(kwargs.get('quantum', DEFAULT_QUANTUM))
+    seed = int(kwargs.get('seed', 0))
+    out_file = kwargs.get('out') or os.path.join(get_batchscore_dir(dataset_name),
+            "bootstrap_auc-%s.txt" % get_timestamp())
+
+    # Per-alignment counts of positives and negatives at each score: the
+    # sufficient statistics for any reweighting of alignments.
+    def count_scores(alignment, scores_cols):
+        return [ScoreCounts.from_scores(scores, alignment.testset, quantum)
+                for scores in scores_cols]
+    partials = list(get_batchscores(dataset_name, batchscore_ids, procs=procs,
+            fn=count_scores))
+    n_aligns = len(partials)
+    if not n_aligns:
+        raise ValueError("No alignments to evaluate")
+    count_mats = [get_count_matrices([p[i] for p in partials])
+            for i in xrange(len(batchscore_ids))]
+
+    aucs = compute_aucs(count_mats, np.ones((1, n_aligns)))[0]
+
+    # Replicates, in chunks small enough to keep memory bounded.
+    n_keys = max(c[0].shape[1] for c in count_mats)
+    chunk_size = max(1, min(n_boot, MAX_CELLS // max(n_keys, 1)))
+    chunks = [(seed + i, min(chunk_size, n_boot - start))
+            for i, start in enumerate(xrange(0, n_boot, chunk_size))]
+    def run_chunk(chunk):
+        chunk_seed, size = chunk
+        weights = np.random.RandomState(chunk_seed).multinomial(
+                n_aligns, np.ones(n_aligns) / n_aligns, size)
+        return compute_aucs(count_mats, weights)
+    if procs == 1 or len(chunks) == 1:
+        boot_aucs = map(run_chunk, chunks)
+    else:
+        boot_aucs = list(parallelize.imap(run_chunk, chunks, nprocs=procs))
+    boot_aucs = np.concatenate(boot_aucs)
+
+    # (scorer, curve, level) arrays of estimates and CIs.
+    qs = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    ci_lo, ci_hi = np.percentile(boot_aucs, qs, axis=0)
+    rows = []
+    for (k, curve), (l, level) in itertools.product(enumerate(CURVES), enumerate(AUC_LEVELS)):
+        for i, batchscore_id in enumerate(batchscore_ids):
+            rows.append((batchscore_id, '-', curve, level, aucs[i,k,l],
+                ci_lo[i,k,l], ci_hi[i,k,l], None))
+        for i, j in itertools.combinations(xrange(len(batchscore_ids)), 2):
+            diffs = boot_aucs[:,i,k,l] - boot_aucs[:,j,k,l]
+            lo, hi = np.percentile(diffs, qs)
+            p = min(1., 2 * min(np.mean(diffs <= 0), np.mean(diffs >= 0)))
+            rows.append((batchscore_ids[i], batchscore_ids[j], curve, level,
+                aucs[i,k,l] - aucs[j,k,l], lo, hi, p))
+
+    print "\n%d bootstrap replicates of %d alignments, %d%% CIs" % (
+            n_boot, n_aligns, round(100 * (1 - alpha)))
+    for curve in CURVES:
+        print "\n%s:" % curve
+        print "AUC_level\tAUC\tCI\tp\tScorer(s)"
+        for id1, id2, c, level, auc, lo, hi, p in rows:
+            if c != curve:
+                continue
+            print "%.2f\t%.4f\t[%.4f, %.4f]\t%s\t%s" % (level, auc, lo, hi,
+                    '' if p is None else "%.4f" % p,
+                    id1 if id2 == '-' else "%s - %s" % (id1, id2))
+
+    with open(out_file, 'w') as f:
+        f.write("# Timestamp: %s\n" % get_timestamp())
+        f.write("# Dataset: %s\n" % dataset_name)
+        f.write("# Replicates: %d, alignments: %d, alpha: %s, quantum: %s, seed: %d\n"
+                % (n_boot, n_aligns, alpha, quantum, seed))
+        f.write("# id1\tid2\tcurve\tauc_level\tauc\tci_low\tci_high\tp_value\n")
+        for id1, id2, curve, level, auc, lo, hi, p in rows:
+            f.write("%s\t%s\t%s\t%s\t%.6f\t%.6f\t%.6f\t%s\n" % (id1, id2, curve,
+                level, auc, lo, hi, '-' if p is None else "%.6f" % p))
+    print "\nWrote %s" % out_file
+
+
+def get_count_matrices(counts_list):
+    """
+    Get sparse (alignments x distinct scores) matrices of the numbers of
+    positive and negative sites, from the ScoreCounts of each alignment in
+    `counts_list`.  Scores are in increasing order.
+    """
+    keys = np.unique(np.concatenate([c.keys for c in counts_list]))
+    rows = np.concatenate([np.repeat(i, len(c.keys)) for i, c in enumerate(counts_list)])
+    cols = np.concatenate([np.searchsorted(keys, c.keys) for c in counts_list])
+    shape = (len(counts_list), len(keys))
+    n_pos = scipy.sparse.csr_matrix((np.concatenate([c.n_pos for c in counts_list]),
+        (rows, cols)), shape=shape, dtype=float)
+    n_neg = scipy.sparse.csr_matrix((np.concatenate([c.n_neg for c in counts_list]),
+        (rows, cols)), shape=shape, dtype=float)
+    return n_pos, n_neg
+
+
+def compute_aucs(count_mats, weights):
+    """
+    Compute AUCs with alignments weighted by each row of `weights`.
+
+    @param count_mats:
+        Per scorer, the count matrices returned by get_count_matrices.
+    @param weights:
+        (replicates x alignments) array of weights.
+    @return:
+        (replicates x scorers x CURVES x AUC_LEVELS) array of AUCs.
+    """
+    aucs = np.empty((len(weights), len(count_mats), len(CURVES), len(AUC_LEVELS)))
+    weights_t = np.asarray(weights, dtype=float).T
+    for i, (n_pos, n_neg) in enumerate(count_mats):
+        # (replicates x distinct scores) weighted counts.
+        fprs, tprs, precisions, recalls = count_curves(
+                n_pos.T.dot(weights_t).T, n_neg.T.dot(weights_t).T)
+        for l, level in enumerate(AUC_LEVELS):
+            aucs[:,i,CURVES.index("PR"),l] = partial_auc(recalls, precisions, level)
+            aucs[:,i,CURVES.index("ROC"),l] = partial_auc(fprs, tprs, level)
+    return aucs
@@ -9,9 +9,10 @@ def compute_summary(dataset_name):
     n_seqs = []
     n_seqs_orig = []
     for alignment, _ in get_batchscores(dataset_name):
-        n_sites.append( len(alignment.msa[0]) )
+        n_seqs_i, n_sites_i = alignment.shape
+        n_sites.append( n_sites_i )
         n_positives.append( alignment.testset.count(1) )
-        n_seqs.append( len(alignment.msa) )
+        n_seqs.append( n_seqs_i )
         n_seqs_orig.append( alignment.orig_num_sequences )
 
     print "Avg # seqs per alignment: %d" % np.mean(n_seqs)
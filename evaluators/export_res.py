@@ -0,0 +1,30 @@
+import os
+from conseval.scorestore import ScoreStore
+from evaluate import get_batchscore_dir
+
+
+def export_res(dataset_name, *batchscore_ids, **kwargs):
+    """
+    Export the scores of batchscore runs in `batchscore_ids` to the legacy
+    format of one .res text file per alignment, for tools that read those.
+
+    Optional kwargs:
+        out_dir: directory to write the files to, in a subdirectory per
+            batchscore id.  By default the files are written to the
+            batchscore id's own directory.
+    """
+    out_dir = kwargs.get('out_dir')
+    ds_dir = get_batchscore_dir(dataset_name)
+    for batchscore_id in batchscore_ids:
+        sc_dir = os.path.join(ds_dir, batchscore_id)
+        if not os.path.exists(sc_dir):
+            raise IOError("%s for dataset %r, scorer %r does not exist"
+                    % (sc_dir, dataset_name, batchscore_id))
+        if out_dir:
+            res_dir = os.path.join(out_dir, batchscore_id)
+            if not os.path.exists(res_dir):
+                os.makedirs(res_dir)
+        else:
+            res_dir = sc_dir
+        count = ScoreStore(sc_dir).export_res(res_dir)
+        print "Exported %d alignments' scores to %s" % (count, res_dir)
@@ -18,6 +18,7 @@ def hist_scores(dataset_name, *batchscore_ids, **kwargs):
         fit_gamma = kwargs['fit_gamma']
     else:
         fit_gamma = False
+    procs = int(kwargs.get('procs', 1))
 
     batchscore_ids = list(batchscore_ids)
     N = len(batchscore_ids)
@@ -25,7 +26,7 @@ def hist_scores(dataset_name, *batchscore_ids, **kwargs):
     neg_cols = [[] for i in xrange(N)]
 
     # Just aggregate all scores across all data files.  It isn't much memory anyway.
-    for alignment, scores_cols in get_batchscores(dataset_name, batchscore_ids):
+    for alignment, scores_cols in get_batchscores(dataset_name, batchscore_ids, procs=procs):
         ts = alignment.testset
         for pos_col, neg_col, scores_col in zip(pos_cols, neg_cols, scores_cols):
             pos_col += (scores_col[i] for i in xrange(len(scores_col)) if ts[i])
@@ -0,0 +1,59 @@
+from __future__ import division
+import glob
+import numpy as np
+import os
+from conseval.io import read_metrics
+from evaluate import get_batchscore_dir
+
+
+def metrics_report(dataset_name, *batchscore_ids, **kwargs):
+    """
+    Summarize the metrics recorded by batchscore runs on `dataset_name`, for
+    each scorer id in `batchscore_ids` (or all, if none given): throughput in
+    sites per second, percentiles of the time per alignment, peak memory
+    growth, and the slowest alignments.
+
+    Optional kwargs:
+        run: only use the metrics file of the run with this timestamp, e.g.
+            20131105-143211.  By default use all runs.
+        n_slowest: number of slowest alignments to list (default 5).
+    """
+    run = kwargs.get('run')
+    n_slowest = int(kwargs.get('n_slowest', 5))
+
+    ds_dir = get_batchscore_dir(dataset_name)
+    fnames = sorted(glob.glob(os.path.join(ds_dir, "metrics-%s.txt" % (run or '*'))))
+    if not fnames:
+        raise IOError("No metrics files in %s" % ds_dir)
+    records_by_id = {}
+    for fname in fnames:
+        for record in read_metrics(fname):
+            if batchscore_ids and record['id'] not in batchscore_ids:
+                continue
+            records_by_id.setdefault(record['id'], []).append(record)
+
+    print "Metrics for dataset %r from %d run(s)" % (dataset_name, len(fnames))
+    for batchscore_id in (batchscore_ids or sorted(records_by_id)):
+        records = records_by_id.get(batchscore_id)
+        if not records:
+            print "\n%s: no metrics" % batchscore_id
+            continue
+        wall_times = np.array([r['wall_time'] for r in records])
+        cpu_times = np.array([r['cpu_time'] for r in records])
+        n_sites = np.array([r['n_sites'] for r in records])
+        rss_deltas = np.array([r['max_rss_delta'] for r in records])
+        p50, p90, p99 = np.percentile(wall_times, [50, 90, 99])
+
+        print "\n%s (%s):" % (batchscore_id, records[-1]['scorer'])
+        print "\talignments: %d, total time %.1fs (cpu %.1fs)" % (
+                len(records), np.sum(wall_times), np.sum(cpu_times))
+        print "\tthroughput: %.1f sites/s" % (np.sum(n_sites) / max(np.sum(wall_times), 1e-9))
+        print "\ttime per alignment: p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs" % (
+                p50, p90, p99, np.max(wall_times))
+        print "\tpeak memory growth: max %d KB, total %d KB" % (
+                np.max(rss_deltas), np.sum(rss_deltas))
+        print "\tslowest alignments:"
+        for i in np.argsort(-wall_times)[:n_slowest]:
+            r = records[i]
+            print "\t\t%.3fs\t%d x %d\t%s" % (r['wall_time'], r['n_seqs'],
+                    r['n_sites'], r['align_file'])
@@ -2,10 +2,12 @@ from __future__ import division
 import bisect
 import numpy as np
 import matplotlib.pyplot as plt
+import os
 import random
-from sklearn.metrics import roc_curve, precision_recall_curve
 
-from evaluate import get_batchscores
+from conseval.utils.general import get_timestamp
+from conseval.utils.stats import ScoreCounts, partial_auc, DEFAULT_QUANTUM
+from evaluate import get_batchscores, get_batchscore_dir
 
 
 # This code is temporary
@@ -20,50 +22,65 @@ def to_keep(ts):
 # End temporary code
 
 
-def pr_roc(dataset_name, *batchscore_ids):
+def pr_roc(dataset_name, *batchscore_ids, **kwargs):
     """
-    Draw PR and ROC curves for each scorer.
+    Compute PR and ROC curves for each scorer, and their AUCs up to each of
+    AUC_LEVELS.  The AUCs are printed and written to a tab-separated results
+    file.  Scores and labels are streamed through, so memory doesn't grow
+    with the size of the dataset.
+
+    Optional kwargs:
+        procs: number of processes to load scores with (default 1, 0 for
+            the number of CPUs).
+        quantum: scores are rounded to multiples of this before computing
+            the curves (default .0001, the precision of .res files).  This
+            bounds the memory used by the number of distinct scores.
+        out: results file (default pr_roc-<timestamp>.txt in the dataset's
+            batchscore dir).
+        plot: if set, save plots of the curves next to the results file.
+        show: if set, show plots of the curves.
     """
-    allscores_cols = [[] for i in batchscore_ids]
-    test_scores = []
-
-    # Just aggregate all scores across all data files.  It isn't much memory anyway.
-    for alignment, scores_cols in get_batchscores(dataset_name, batchscore_ids):
-        ts = alignment.testset
-        counts = []
-        for allscores_col, scores in zip(allscores_cols, scores_cols):
-            counts.append(ts.count(None))
-            allscores_col += [scores[i] for i in xrange(len(ts)) if ts[i] is not None]
-        test_scores += [ts[i] for i in xrange(len(ts)) if ts[i] is not None]
+    procs = int(kwargs.get('procs', 1))
+    quantum = float(kwargs.get('quantum', DEFAULT_QUANTUM))
+    out_file = kwargs.get('out') or os.path.join(get_batchscore_dir(dataset_name),
+            "pr_roc-%s.txt" % get_timestamp())
+
+    def count_scores(alignment, scores_cols):
+        return [ScoreCounts.from_scores(scores, alignment.testset, quantum)
+                for scores in scores_cols]
+
+    scorer_counts = [ScoreCounts() for _ in batchscore_ids]
+    for partials in get_batchscores(dataset_name, batchscore_ids, procs=procs,
+            fn=count_scores):
+        for counts, partial in zip(scorer_counts, partials):
+            counts.merge(partial)
 
     scorer_fprs = []
     scorer_tprs = []
     scorer_precisions = []
     scorer_recalls = []
-    for allscores_col in allscores_cols:
-        fprs, tprs, _ = roc_curve(test_scores, allscores_col, pos_label=1)
+    for counts in scorer_counts:
+        fprs, tprs, precisions, recalls = counts.curves()
         scorer_fprs.append(fprs)
         scorer_tprs.append(tprs)
-        precisions, recalls, _ = precision_recall_curve(test_scores, allscores_col, pos_label=1)
         scorer_precisions.append(precisions)
         scorer_recalls.append(recalls)
 
-    print_auc("PR", batchscore_ids, scorer_recalls, scorer_precisions)
-    print_auc("ROC", batchscore_ids, scorer_fprs, scorer_tprs)
+    pr_aucs = print_auc("PR", batchscore_ids, scorer_recalls, scorer_precisions)
+    roc_aucs = print_auc("ROC", batchscore_ids, scorer_fprs, scorer_tprs)
+    write_aucs(out_file, dataset_name, batchscore_ids, scorer_counts,
+            [("PR", pr_aucs), ("ROC", roc_aucs)], quantum)
+    print "\nWrote %s" % out_file
 
-    plot_pr(dataset_name, scorer_precisions, scorer_recalls, batchscore_ids)
-    plot_roc(dataset_name, scorer_fprs, scorer_tprs, batchscore_ids, .5)
-    plt.show(block=False)
-
-    print """\n* To plot another PR curve:
-plot_pr(dataset_name, scorer_precisions, scorer_recalls, batchscore_ids, legend='upper right')
-plt.show()"""
-    print """\n* To plot another ROC curve:
-plot_roc(dataset_name, scorer_fprs, scorer_tprs, batchscore_ids, x_max=.5, legend='lower right')
-plt.show()"""
-    print ""
-    import ipdb
-    ipdb.set_trace()
+    if kwargs.get('plot') or kwargs.get('show'):
+        fig_pr = plot_pr(dataset_name, scorer_precisions, scorer_recalls, batchscore_ids)
+        fig_roc = plot_roc(dataset_name, scorer_fprs, scorer_tprs, batchscore_ids, .5)
+        if kwargs.get('plot'):
+            prefix = os.path.splitext(out_file)[0]
+            fig_pr.savefig(prefix + "-pr.png")
+            fig_roc.savefig(prefix + "-roc.png")
+        if kwargs.get('show'):
+            plt.show()
 
 
 def plot_pr(name, scorer_precisions, scorer_recalls, batchscore_ids, legend='upper right'):
@@ -114,17 +131,13 @@ def plot_roc(name, scorer_fprs, scorer_tprs, batchscore_ids, x_max=1, legend='lo
 AUC_LEVELS = [.1, .5, 1]
 def print_auc(name, batchscore_ids, scorer_xs, scorer_ys):
     """
-    This doesn't work for PR curves
+    Print and return the AUCs of each scorer's curve up to each of AUC_LEVELS
+    on the x axis (i.e. FPR for ROC curves, recall for PR curves).
     """
     # Compute AUCs for each scorer
     scorers_aucs = []
     for xs, ys in zip(scorer_xs, scorer_ys):
-        scorer_aucs = []
-        for auc_level in AUC_LEVELS:
-            inds_bool = xs < auc_level
-            auc = np.trapz(ys[inds_bool], xs[inds_bool])
-            scorer_aucs.append(auc)
-        scorers_aucs.append(scorer_aucs)
+        scorers_aucs.append([partial_auc(xs, ys, auc_level) for auc_level in AUC_LEVELS])
 
     print ""
     print "%s:" % name
@@ -135,3 +148,22 @@ def print_auc(name, batchscore_ids, scorer_xs, scorer_ys):
             line.append("%.4f"%auc)
         line.append(batchscore_id)
         print "\t".join(line)
+    return scorers_aucs
+
+
+def write_aucs(fname, dataset_name, batchscore_ids, scorer_counts, curve_aucs, quantum):
+    """
+    Write the AUCs in `curve_aucs`, a list of (curve name, AUCs returned by
+    print_auc), to the tab-separated file `fname`.
+    """
+    with open(fname, 'w') as f:
+        f.write("# Timestamp: %s\n" % get_timestamp())
+        f.write("# Dataset: %s\n" % dataset_name)
+        f.write("# Quantum: %s\n" % quantum)
+        f.write("# id\tcurve\tauc_level\tauc\tn_pos\tn_neg\n")
+        for curve, scorers_aucs in curve_aucs:
+            for batchscore_id, counts, aucs in zip(batchscore_ids, scorer_counts, scorers_aucs):
+                n_pos, n_neg = counts.totals()
+                for auc_level, auc in zip(AUC_LEVELS, aucs):
+                    f.write("%s\t%s\t%s\t%.6f\t%d\t%d\n" % (batchscore_id, curve,
+                        auc_level, auc, n_pos, n_neg))
@@ -1,14 +1,11 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import random
-import os
 from conseval.alignment import Alignment, MockAlignment
 from conseval.datasets import DATASET_CONFIGS
-from evaluate import get_batchscores, get_batchscore_dir
-from conseval.io import read_batchscores
-from conseval.utils.bio import get_column, amino_acids
-from conseval.utils.general import weighted_choice
-from scorers.rate4site_eb import Rate4siteEb, precompute_tree_probs
+from evaluate import get_batchscores
+from conseval.simulation import simulate_msa
+from scorers.rate4site_eb import Rate4siteEb
 from scorers.js_divergence import JsDivergence
 
 
@@ -17,62 +14,30 @@ def r4s_ppc(dataset_name, **jsd_params):
     afs = list(get_batchscores(dataset_name, align_files_only=True))
 
     dc = DATASET_CONFIGS[dataset_name]
-    r4s_name = 'R4S_EB-vanilla'
-    r4s_dir = os.path.join(get_batchscore_dir(dataset_name), r4s_name)
 
-    r4s = Rate4siteEb()
+    # Batchscore output is negated and windowed, so compute raw rates.
+    r4s = Rate4siteEb(window_size=0, normalize=False)
     jsd = JsDivergence(**jsd_params)
 
     # Choose random alignment/scores pair
     align_file = random.choice(afs)
     test_file = dc.get_test_file(align_file)
-    r4s_file = dc.get_out_file(align_file, r4s_dir)
     alignment = Alignment(align_file, test_file=test_file, parse_testset_fn=dc.parse_testset_fn)
-    n_seqs = len(alignment.msa)
-    n_sites = len(alignment.msa[0])
+    n_seqs, n_sites = alignment.msa_array.shape
 
     fig = plt.figure()
     ax = plt.gca()
     inds = range(n_sites)
 
-    rates = read_batchscores(r4s_file)
+    rates = [-score for score in r4s.score(alignment)]
     tree = alignment.get_phylotree()
-    root = tree.root
-    names_map = dict((name,i) for i,name in enumerate(alignment.names))
 
-    # Pre-compute probabilities for branch, for every site (i.e., rate)
-    P_cached = precompute_tree_probs(tree, rates, r4s.sub_model)
-    for r in P_cached:
-        for node in P_cached[r]:
-            # We treat root separately
-            if node != root:
-                cum_probs = np.cumsum(P_cached[r][node],axis=1)
-                if not np.all(np.abs(cum_probs[:,-1]-1) < 1e-4):
-                    raise ValueError("Bad probability matrix")
-                cum_probs[:,-1] = 1
-                P_cached[r][node] = np.array(cum_probs)
-    root_freqs = np.cumsum(r4s.sub_model.freqs)
-    if not abs(root_freqs[-1]-1) < 1e-4:
-        raise ValueError("Bad probability matrix")
-    root_freqs[-1] = 1
-
-    # Repeat replication for N_RUNS
+    # Simulate N_RUNS replicate alignments from the rates and tree, and
+    # score them.
+    msa_reps = simulate_msa(tree, alignment.names, rates, r4s.sub_model, N_RUNS)
     jsd_rep_scores_all = []
-    for n in xrange(N_RUNS):
-        # For each site, generate amino acids for each sequence using that site's rate
-        # DFS through tree, setting amino acids at each node
-        msa = [[] for i in xrange(n_seqs)]
-        for i in xrange(n_sites):
-            r = rates[i]
-            aa_ind = weighted_choice(root_freqs)
-            bfs = [(aa_ind,node) for node in root.clades]
-            for aa_ind, node in bfs:
-                aa_ind = weighted_choice(P_cached[r][node][aa_ind])
-                if node.is_terminal():
-                    msa[names_map[node.name]].append(amino_acids[aa_ind])
-                else:
-                    bfs += ((aa_ind,child) for child in node.clades)
-        aln_rep = MockAlignment(alignment.names, msa, tree, alignment.get_seq_weights)
+    for msa_rep in msa_reps:
+        aln_rep = MockAlignment(alignment.names, msa_rep, tree, alignment.get_seq_weights)
         jsd_rep_scores = jsd.score(aln_rep)
         jsd_rep_scores_all.append(jsd_rep_scores)
         ax.scatter(inds, jsd_rep_scores, color='k', alpha=0.2)
@@ -103,6 +68,4 @@ def r4s_ppc(dataset_name, **jsd_params):
     plt.xlabel('Rates')
     plt.xlabel('Deviations')
 
-    plt.show(block=False)
-    import ipdb
-    ipdb.set_trace()
+    plt.show()
@@ -2,15 +2,18 @@
 """
 Score a single alignment using a single scorer.  Print scores in
 a pleasant human-readable format.
+
+With -s, scoring is done by a scoring server started by `score.py --serve`
+if one is running, which saves loading the scorer on every run.  Modules
+that are slow to import are only imported where needed, so that runs using
+the server start quickly.
 """
 from __future__ import division
 import argparse
 import sys
-from conseval.alignment import Alignment
 from conseval.io import write_score_helper, read_score_helper, list_scorer_params, parse_params
-from conseval.scorer import get_scorer, get_scorer_cls
-from conseval.utils.bio import get_column
-from conseval.utils.general import get_all_module_names
+from conseval.server import DEFAULT_SOCKET, ScoreServer, ServerUnavailable, \
+        open_alignment, score_remote
 
 
 
@@ -29,9 +32,12 @@ def write_scores(alignment, scores_cols, scorer_names, f=sys.stdout, header=None
     if not len(scores_cols) == len(scorer_names):
         raise ValueError("Mismatch between inputs 'scores_cols' and 'scorer_names'")
 
+    from conseval.utils.bio import decode_msa
+
+    n_seqs, n_sites = alignment.msa_array.shape
     f.write("# Alignment: %s\n" % alignment.align_file)
-    f.write("# Num sites: %d\n" % len(alignment.msa[0]))
-    f.write("# Num sequences: %d\n" % len(alignment.names))
+    f.write("# Num sites: %d\n" % n_sites)
+    f.write("# Num sequences: %d\n" % n_seqs)
     if alignment.filtered:
         f.write("# Num sequences before filtering: %d\n" % alignment.orig_num_sequences)
     f.write("\n")
@@ -44,8 +50,9 @@ def write_scores(alignment, scores_cols, scorer_names, f=sys.stdout, header=None
     # print scores
     f.write("# i\tcolumn\t%s\n" % "\t".join(scorer_names))
     score_tups = zip(*scores_cols)
+    sites = decode_msa(alignment.msa_array.T)
     for i, score_tup in enumerate(score_tups):
-        site = "".join(get_column(i, alignment.msa))
+        site = "".join(sites[i])
         f.write("%d\t%s\t%s\n" % (i+1, site, "\t".join(map(write_score_helper, score_tup))))
 
 
@@ -101,6 +108,7 @@ def draw_scores(alignment, scores_cols, scorer_names):
 
 
 def list_alignment_paramdefs():
+    from conseval.alignment import Alignment
     print "================"
     print "Alignment params:"
     print "================"
@@ -109,6 +117,8 @@ def list_alignment_paramdefs():
 
 
 def list_scorer_paramdefs(scorer_names=None):
+    from conseval.scorer import get_scorer_cls
+    from conseval.utils.general import get_all_module_names
     if not scorer_names:
         scorer_names = get_all_module_names('scorers')
     for scorer_name in scorer_names:
@@ -132,7 +142,7 @@ def list_scorer_paramdefs(scorer_names=None):
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Score the conservation of a single alignment file, using a single scorer.",
-        usage="%(prog)s [-h] [-l] scorer_name align_file [-a ALIGN_PARAMS] [-p SCORER_PARAMS]")
+        usage="%(prog)s [-h] [-l] [--serve] scorer_name align_file [-a ALIGN_PARAMS] [-p SCORER_PARAMS] [-s]")
 
     parser.add_argument('-l', dest='list_params', default=None,
         nargs=argparse.REMAINDER,
@@ -141,7 +151,7 @@ def parse_args():
     parser.add_argument('scorer_name', nargs="?",
         help="conservation estimation method")
     parser.add_argument('align_file', nargs="?",
-        help="path to alignment file to score")
+        help="path to alignment file to score, or - to read it from stdin")
 
     parser.add_argument('-a', dest='align_params', action='append', default=[],
         help="parameters associcated with align_file, can specify multiple. Specify as '-a inputName=inputValue', e.g. '-a tree_file=tree.txt'")
@@ -151,11 +161,20 @@ def parse_args():
     parser.add_argument('-d', dest='draw', action='store_true',
         help="draw visual of scores")
 
+    parser.add_argument('-s', dest='use_server', action='store_true',
+        help="score using the scoring server, if one is running, and otherwise score as usual.  Not used with -d")
+    parser.add_argument('--serve', action='store_true',
+        help="run a scoring server, which keeps scorers loaded between requests, until killed")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+        help="socket of the scoring server (default: %(default)s)")
+
     args = parser.parse_args()
     if args.list_params is not None:
         list_alignment_paramdefs()
         list_scorer_paramdefs(args.list_params)
         sys.exit(0)
+    elif args.serve:
+        return args
     elif not args.scorer_name or not args.align_file:
         parser.print_usage()
         sys.stderr.write("%s: error: too few arguments\n" % sys.argv[0])
@@ -169,21 +188,49 @@ def parse_args():
 def main():
     args = parse_args()
 
+    if args.serve:
+        server = ScoreServer(write_scores, args.socket)
+        sys.stderr.write("Scoring server listening on %s\n" % args.socket)
+        server.serve_forever()
+
+    align_text = None
+    if args.align_file == '-':
+        align_text = sys.stdin.read()
+
+    if args.use_server and not args.draw:
+        try:
+            response = score_remote(args.socket, args.scorer_name,
+                    align_file=None if align_text is not None else args.align_file,
+                    alignment=align_text, scorer_params=args.scorer_params,
+                    align_params=args.align_params)
+        except ServerUnavailable, e:
+            sys.stderr.write("%s, scoring without it\n" % e)
+        else:
+            if not response['ok']:
+                sys.stderr.write(response['error'])
+                sys.exit(1)
+            sys.stdout.write(response['output'])
+            return
+
+    from conseval.phylotree import format_tree_cache_stats
+    from conseval.scorer import get_scorer
+
     # Get scorer
     scorer = get_scorer(args.scorer_name, **args.scorer_params)
 
     # Get alignment and supplementary inputs
-    alignment = Alignment(args.align_file, **args.align_params)
-
-    # Score
-    scores = scorer.score(alignment)
-
-    # Output
-    header = list_scorer_params(scorer)
-    scores_cols = [scores]
-    write_scores(alignment, scores_cols, [args.scorer_name], header=header, f=sys.stdout)
-    if args.draw:
-        draw_scores(alignment, scores_cols, [args.scorer_name])
+    with open_alignment(args.align_file, align_text, **args.align_params) as alignment:
+        # Score
+        scores = scorer.score(alignment)
+
+        # Output
+        header = list_scorer_params(scorer)
+        scores_cols = [scores]
+        write_scores(alignment, scores_cols, [args.scorer_name], header=header, f=sys.stdout)
+        if args.draw:
+            draw_scores(alignment, scores_cols, [args.scorer_name])
+    if format_tree_cache_stats():
+        sys.stderr.write("%s\n" % format_tree_cache_stats())
 
 
 if __name__ == "__main__":
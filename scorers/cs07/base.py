@@ -2,10 +2,11 @@
 Code largely by Tony Capra 2007.
 """
 from __future__ import division
+import numpy as np
 
 from conseval.params import ParamDef
 from conseval.scorer import Scorer
-from conseval.utils.bio import get_column, weighted_gap_penalty, amino_acids
+from conseval.utils.bio import amino_acids, decode_msa, GAP_INDEX
 
 
 IS_BASE_SCORER = 1
@@ -34,32 +35,53 @@ class Cs07Scorer(Scorer):
         if self.use_seq_weights:
             seq_weights = alignment.get_seq_weights()
         else:
-            seq_weights = [1.] * len(alignment.msa)
+            seq_weights = [1.] * len(alignment.msa_array)
 
         # Estimate bg distribution from this alignment
         if hasattr(self, 'bg_distribution'):
-            if not self.bg_distribution:
+            if self.bg_distribution is None:
                 q = dict((aa, 0) for aa in amino_acids)
-                for seq in self.msa:
+                for seq in alignment.msa:
                     for aa in seq:
                         q[aa] += 1
                 self.bg_distribution = q
 
-        scores = []
-        for i in xrange(len(alignment.msa[0])):
-            col = get_column(i, alignment.msa)
-            n_gaps = col.count('-')
-            assert n_gaps < len(col)
-            if self.gap_cutoff != 1 and n_gaps/len(col) > self.gap_cutoff:
-                score = self.SCORE_OVER_GAP_CUTOFF
-            else:
-                score = self._score_col(col, seq_weights)
-                if self.use_gap_penalty:
-                    # vn_entropy has this commented out for some reason
-                    score *= weighted_gap_penalty(col, seq_weights)
-            scores.append(score)
+        freq_counts = alignment.get_freq_counts(self.use_seq_weights)
+        n_seqs = len(alignment.msa_array)
+        n_gaps = alignment.get_freq_counts(False)[:,GAP_INDEX]
+        assert np.all(n_gaps < n_seqs)
+
+        scores = self._score_cols(alignment, freq_counts, seq_weights)
+        if self.use_gap_penalty:
+            # vn_entropy has this commented out for some reason
+            scores = scores * (1 - freq_counts[:,GAP_INDEX] / np.sum(seq_weights))
+
+        scores = list(scores)
+        if self.gap_cutoff != 1:
+            for i in np.flatnonzero(n_gaps/n_seqs > self.gap_cutoff):
+                scores[i] = self.SCORE_OVER_GAP_CUTOFF
         return scores
 
 
+    def _score_cols(self, alignment, freq_counts, seq_weights):
+        """
+        Score all columns of `alignment` at once, before any gap penalty or
+        gap cutoff is applied.  Override with an array expression over
+        `freq_counts`, the (sites x len(amino_acids)) array of weighted
+        frequency counts of the alignment.
+
+        By default, calls _score_col once for each unique column pattern.
+
+        @return:
+            Array of scores for each site
+        """
+        # Identical columns get identical scores, so score each unique column
+        # pattern once.
+        patterns, _, site_patterns = alignment.get_column_patterns()
+        pattern_scores = np.array([self._score_col(col, seq_weights)
+                for col in decode_msa(patterns.T)])
+        return pattern_scores[site_patterns]
+
+
     def _score_col(self, col, seq_weights):
         raise NotImplementedError()
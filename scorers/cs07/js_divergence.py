@@ -2,11 +2,11 @@
 Jensen-Shannon Divergence (Capra and Singh 07)
 Code by Josh Chen 2013.  Idea from Tony Capra 2007.
 """
-import math
+import numpy as np
 from conseval.params import ParamDef
 from scorers.cs07.base import Cs07Scorer
 from conseval.substitution import paramdef_bg_distribution
-from conseval.utils.bio import weighted_freq_count_pseudocount, PSEUDOCOUNT
+from conseval.utils.bio import freq_counts_pseudocount, PSEUDOCOUNT
 
 
 class JsDivergence(Cs07Scorer):
@@ -20,25 +20,26 @@ class JsDivergence(Cs07Scorer):
     SCORE_OVER_GAP_CUTOFF = 0
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
-        Return the Jensen-Shannon Divergence for the column with the background
+        Return the Jensen-Shannon Divergence for each column with the background
         distribution q.
         """
         q = self.bg_distribution
         lamb1 = self.lambda_prior
         lamb2 = 1-self.lambda_prior
 
-        # get frequency distribution
+        # get frequency distribution.  The pseudocount makes all frequencies
+        # nonzero.
         with_gap = (len(q) == 21)
-        pc = weighted_freq_count_pseudocount(col, seq_weights, PSEUDOCOUNT, with_gap)
-        assert len(pc) == len(q)
+        pc = freq_counts_pseudocount(freq_counts, PSEUDOCOUNT, with_gap)
+        assert pc.shape[1] == len(q)
 
         # make r distriubtion
         r = lamb1*pc + lamb2*q
 
         # sum relative entropies
-        d1 = lamb1 * sum(pc[i] * math.log(pc[i]/r[i], 2) for i in xrange(len(pc)) if pc[i])
-        d2 = lamb2 * sum(q[i] * math.log(q[i]/r[i], 2) for i in xrange(len(pc)) if pc[i])
+        d1 = lamb1 * np.sum(pc * np.log2(pc/r), axis=1)
+        d2 = lamb2 * np.sum(q * np.log2(q/r), axis=1)
 
         return d1+d2
@@ -3,9 +3,10 @@ Property Relative Entropy (Williamson 95)
 Code copyright Tony Capra 2007.
 """
 import math
+import numpy as np
 from scorers.cs07.base import Cs07Scorer
 from conseval.substitution import paramdef_bg_distribution
-from conseval.utils.bio import aa_to_index, weighted_freq_count_pseudocount, PSEUDOCOUNT
+from conseval.utils.bio import freq_counts_pseudocount, partition_matrix, PSEUDOCOUNT
 
 
 class PropertyRelativeEntropy(Cs07Scorer):
@@ -18,34 +19,33 @@ class PropertyRelativeEntropy(Cs07Scorer):
     SCORE_OVER_GAP_CUTOFF = 0
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
-        Calculate the relative entropy of a column col relative to a
+        Calculate the relative entropy of each column relative to a
         partition of the amino acids. Similar to Williamson '95.  See shannon_entropy()
         for more general info.
         """
-        if len(self.bg_distribution) == len(self.property_partition):
-            prop_bg_freq = self.bg_distribution
+        n_props = len(self.property_partition)
+        if len(self.bg_distribution) == n_props:
+            prop_bg_freq = np.asarray(self.bg_distribution)
         else:
             # XXX: shouldn't we sum the bg distribution frequencies instead of using
             # some fixed prop bg freq?
-            prop_bg_freq = self.prop_bg_freq
+            prop_bg_freq = np.array(self.prop_bg_freq[:n_props])
 
-        fc = weighted_freq_count_pseudocount(col, seq_weights, PSEUDOCOUNT)
+        fc = freq_counts_pseudocount(freq_counts, PSEUDOCOUNT)
 
-        # sum the aa frequencies to get the property frequencies
-        prop_fc = [0.] * len(self.property_partition)
-        for p in xrange(len(self.property_partition)):
-            for aa in self.property_partition[p]:
-                prop_fc[p] += fc[aa_to_index[aa]]
+        # sum the aa frequencies to get the property frequencies.  The
+        # pseudocount makes all property frequencies nonzero.
+        prop_fc = np.dot(fc, partition_matrix(self.property_partition))
 
-        d = 0.
-        for i in xrange(len(prop_fc)):
-            if prop_fc[i] and prop_bg_freq[i]:
-                d += prop_fc[i] * math.log(prop_fc[i] / prop_bg_freq[i], 2)
+        # Skip properties with zero background frequency.
+        prop_fc = prop_fc[:,prop_bg_freq > 0]
+        prop_bg_freq = prop_bg_freq[prop_bg_freq > 0]
+        d = np.sum(prop_fc * np.log2(prop_fc / prop_bg_freq), axis=1)
 
         # Convert score so that it's between 0 and 1.
         # XXX: why is relative entropy assumed to be bounded?
-        d /= math.log(len(prop_fc))
+        d /= math.log(n_props)
 
         return d
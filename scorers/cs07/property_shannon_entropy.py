@@ -3,8 +3,9 @@ Property Entropy (Mirny and Shakhnovich 95, Valdar and Thornton 01)
 Code copyright Tony Capra 2007.
 """
 import math
+import numpy as np
 from scorers.cs07.base import Cs07Scorer
-from conseval.utils.bio import aa_to_index, weighted_freq_count_pseudocount, PSEUDOCOUNT
+from conseval.utils.bio import freq_counts_pseudocount, partition_matrix, PSEUDOCOUNT
 
 
 class PropertyShannonEntropy(Cs07Scorer):
@@ -15,28 +16,23 @@ class PropertyShannonEntropy(Cs07Scorer):
     SCORE_OVER_GAP_CUTOFF = 0
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
-        Calculate the entropy of a column col relative to a partition of the
+        Calculate the entropy of each column relative to a partition of the
         amino acids. Similar to Mirny '99.
         """
-        fc = weighted_freq_count_pseudocount(col, seq_weights, PSEUDOCOUNT)
+        fc = freq_counts_pseudocount(freq_counts, PSEUDOCOUNT)
 
-        # sum the aa frequencies to get the property frequencies
-        prop_fc = [0.] * len(self.property_partition)
-        for p in range(len(self.property_partition)):
-            for aa in self.property_partition[p]:
-                prop_fc[p] += fc[aa_to_index[aa]]
+        # sum the aa frequencies to get the property frequencies.  The
+        # pseudocount makes all property frequencies nonzero.
+        prop_fc = np.dot(fc, partition_matrix(self.property_partition))
 
-        h = 0.
-        for pfc_i in prop_fc:
-            if pfc_i:
-                h -= pfc_i * math.log(pfc_i)
+        h = -np.sum(prop_fc * np.log(prop_fc), axis=1)
 
         # Convert score so that it's between 0 and 1.
         # Recall that shannon entropy is between 0 and log(number of values with nonzero freq)
         # XXX: Why involve len(col) if we have a pseudocount?
-        h /= math.log(min(len(self.property_partition), len(col)))
+        h /= math.log(min(len(self.property_partition), len(alignment.msa_array)))
 
         # Convert score so that 1 is conserved, and 0 is not.
         return 1 - h
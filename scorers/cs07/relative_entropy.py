@@ -5,7 +5,7 @@ Code copyright Tony Capra 2007.
 import numpy as np
 from scorers.cs07.base import Cs07Scorer
 from conseval.substitution import paramdef_bg_distribution
-from conseval.utils.bio import weighted_freq_count_pseudocount, PSEUDOCOUNT
+from conseval.utils.bio import freq_counts_pseudocount, PSEUDOCOUNT
 
 
 class RelativeEntropy(Cs07Scorer):
@@ -15,22 +15,22 @@ class RelativeEntropy(Cs07Scorer):
     SCORE_OVER_GAP_CUTOFF = 0
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
-        Calculate the relative entropy of the column distribution with a
+        Calculate the relative entropy of each column's distribution with a
         background distribution specified in bg_distr. This is similar to the
         approach proposed in Wang and Samudrala 06.
         """
         q = self.bg_distribution
 
         with_gap = (len(q) == 21)
-        fc = weighted_freq_count_pseudocount(col, seq_weights, PSEUDOCOUNT, with_gap)
-        assert len(fc) == len(q)
+        fc = freq_counts_pseudocount(freq_counts, PSEUDOCOUNT, with_gap)
+        assert fc.shape[1] == len(q)
 
-        d = np.sum(fc * np.log(fc/q))
+        d = np.sum(fc * np.log(fc/q), axis=1)
 
         # Convert score so that it's between 0 and 1.
         # XXX: why is relative entropy assumed to be bounded?
-        d /= np.log(len(fc))
+        d /= np.log(fc.shape[1])
 
         return d
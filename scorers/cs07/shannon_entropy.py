@@ -2,9 +2,9 @@
 Shannon Entropy
 Code copyright Tony Capra 2007.
 """
-import math
+import numpy as np
 from scorers.cs07.base import Cs07Scorer
-from conseval.utils.bio import weighted_freq_count_pseudocount, PSEUDOCOUNT
+from conseval.utils.bio import freq_counts_pseudocount, PSEUDOCOUNT
 
 
 class ShannonEntropy(Cs07Scorer):
@@ -12,24 +12,22 @@ class ShannonEntropy(Cs07Scorer):
     SCORE_OVER_GAP_CUTOFF = 0
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
-        Calculates the Shannon entropy of the column col.
+        Calculates the Shannon entropy of each column.
         The entropy will be between zero and one because of its base. See p.13 of
         Valdar 02 for details. The information score 1 - h is returned for the sake
         of consistency with other scores.
         """
-        fc = weighted_freq_count_pseudocount(col, seq_weights, PSEUDOCOUNT)
+        # The pseudocount makes all frequencies nonzero.
+        fc = freq_counts_pseudocount(freq_counts, PSEUDOCOUNT)
 
-        h = 0.
-        for fc_i in fc:
-            if fc_i:
-                h -= fc_i * math.log(fc_i)
+        h = -np.sum(fc * np.log(fc), axis=1)
 
         # Convert score so that it's between 0 and 1.
         # Recall that shannon entropy is between 0 and log(number of values with nonzero freq)
         # XXX: Why involve len(col) if we have a pseudocount?
-        h /= math.log(len(fc))#math.log(min(len(fc), len(col)))
+        h /= np.log(fc.shape[1])#math.log(min(len(fc), len(col)))
 
         # Convert score so that 1 is conserved, and 0 is not.
         return 1 - h
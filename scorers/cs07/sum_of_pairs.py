@@ -2,9 +2,11 @@
 Mutation Weighted Pairwise Match
 Code copyright Tony Capra 2007.
 """
+from __future__ import division
+import numpy as np
 from scorers.cs07.base import Cs07Scorer
 from conseval.substitution import paramdef_sim_matrix
-from conseval.utils.bio import aa_to_index
+from conseval.utils.bio import weighted_freq_counts, GAP_INDEX
 
 
 class SumOfPairs(Cs07Scorer):
@@ -18,23 +20,25 @@ class SumOfPairs(Cs07Scorer):
     # for SCORE_OVER_GAP_CUTOFF
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
-        Sum the similarity matrix values for all pairs in the column.
+        Sum the similarity matrix values for all pairs in each column.
         This method is similar to those proposed in Valdar 02.
+
+        Rather than looping over all pairs of sequences, use that for the
+        weighted counts c of each amino acid in a column,
+            \sum_{i<j} w_i w_j S[a_i][a_j] = (c' S c - \sum_i w_i^2 S[a_i][a_i]) / 2
+        where the sums are over non-gap sequences.
         """
-        curr_sum = 0.
-        max_sum = 0.
-        for i in xrange(len(col)):
-            for j in xrange(i):
-                if col[i] != '-' and col[j] != '-':
-                    max_sum += seq_weights[i] * seq_weights[j]
-                    curr_sum += seq_weights[i] * seq_weights[j] * \
-                            self.sim_matrix[aa_to_index[col[i]]][aa_to_index[col[j]]]
-
-        if max_sum:
-            curr_sum /= max_sum
-        else:
-            curr_sum = 0.
-
-        return curr_sum
+        S = np.asarray(self.sim_matrix)[:GAP_INDEX,:GAP_INDEX]
+        c = freq_counts[:,:GAP_INDEX]
+        # Counts weighted by squared sequence weights, for the self-pairs.
+        c_sq = weighted_freq_counts(alignment.msa_array, np.square(seq_weights))[:,:GAP_INDEX]
+
+        curr_sum = (np.sum(np.dot(c, S) * c, axis=1) - np.dot(c_sq, np.diag(S))) / 2
+        max_sum = (np.sum(c, axis=1)**2 - np.sum(c_sq, axis=1)) / 2
+
+        scores = np.zeros(len(c))
+        inds = np.flatnonzero(max_sum)
+        scores[inds] = curr_sum[inds] / max_sum[inds]
+        return scores
@@ -6,7 +6,7 @@ import math
 import numpy as np
 from scorers.cs07.base import Cs07Scorer
 from conseval.substitution import paramdef_sim_matrix
-from conseval.utils.bio import aa_to_index
+from conseval.utils.bio import GAP_INDEX
 
 
 class VnEntropy(Cs07Scorer):
@@ -16,49 +16,37 @@ class VnEntropy(Cs07Scorer):
     SCORE_OVER_GAP_CUTOFF = 0
 
 
-    def _score_col(self, col, seq_weights):
+    def _score_cols(self, alignment, freq_counts, seq_weights):
         """
         Calculate the von Neuman Entropy as described in Caffrey et al. 04.
         This code was adapted from the implementation found in the PFAAT project
         available on SourceForge.
-        """
-
-        aa_counts = [0.] * 20
-        for aa in col:
-            if aa != '-': aa_counts[aa_to_index[aa]] += 1
-
-        dm_aas = []
-        for i in xrange(len(aa_counts)):
-            if aa_counts[i] != 0:
-                dm_aas.append(i)
-        dm_size = len(dm_aas)
-
-        # No non-gap amino acids in col
-        if dm_size == 0: return 0.0
-
-        row_i = 0
-        col_i = 0
-        dm = np.zeros((dm_size, dm_size), np.float32)
-        for i in xrange(dm_size):
-            row_i = dm_aas[i]
-            for j in xrange(dm_size):
-                col_i = dm_aas[j]
-                dm[i][j] = aa_counts[row_i] * self.sim_matrix[row_i][col_i]
 
-        ev = np.linalg.eig(dm)[0].real
+        The density matrix of a column is diag(aa_counts) * S, restricted to
+        the amino acids in the column.  It has the same eigenvalues as the
+        symmetric diag(aa_counts)^(1/2) * S * diag(aa_counts)^(1/2), so the
+        eigenvalues of all columns are computed with a single symmetric
+        eigensolver call on a stack of 20x20 matrices.  Amino acids missing
+        from a column only add zero eigenvalues, which are ignored.
+        """
+        S = np.asarray(self.sim_matrix)[:GAP_INDEX,:GAP_INDEX]
+        # Unweighted counts of the non-gap amino acids in each column.
+        aa_counts = alignment.get_freq_counts(False)[:,:GAP_INDEX]
 
-        temp = 0.
-        for e in ev:
-            temp += e
+        sqrt_counts = np.sqrt(aa_counts)
+        dm = sqrt_counts[:,:,np.newaxis] * S * sqrt_counts[:,np.newaxis,:]
+        ev = np.linalg.eigvalsh(dm)
 
-        if temp != 0:
-            for i in xrange(len(ev)):
-                ev[i] = ev[i] / temp
+        temp = np.sum(ev, axis=1)
+        inds = np.flatnonzero(temp)
+        ev[inds] /= temp[inds,np.newaxis]
 
-        vne = 0.0
-        for e in ev:
-            if e > (10**-10):
-                vne -= e * math.log(e) / math.log(20)
+        is_pos = ev > (10**-10)
+        vne = -np.sum(np.where(is_pos, ev * np.log(np.where(is_pos, ev, 1)), 0), axis=1)
+        vne /= math.log(20)
 
         # Presumably this makes it so that 1 is conserved, and 0 is not.
-        return 1 - vne
+        scores = 1 - vne
+        # No non-gap amino acids in col
+        scores[np.sum(aa_counts, axis=1) == 0] = 0.0
+        return scores
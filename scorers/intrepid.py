@@ -17,11 +17,12 @@ from conseval.alignment import MockAlignment
 from conseval.scorer import Scorer, get_scorer_cls
 from conseval.params import ParamDef
 from conseval.substitution import paramdef_bg_distribution, paramdef_sub_model
-from conseval.utils.bio import get_column
 
 
 class Intrepid(Scorer):
 
+    USES_TREE = True
+
     params = Scorer.params.extend(
         #TODO: clean_fxn shouldn't allow bad subscorer names
         ParamDef('subscorer_cls', 'js_divergence', load_fxn=get_scorer_cls,
@@ -56,7 +57,7 @@ class Intrepid(Scorer):
             # Note that the ordering of sequences in the msa gets messed up.
             inds = [names_map[node.name] for node in subtree.get_terminals()]
             names = [alignment.names[i] for i in inds]
-            msa = [alignment.msa[i] for i in inds]
+            msa = alignment.msa_array[inds]
             tree = subtree
             def get_seq_weights():
                 if alignment._seq_weights:
@@ -7,7 +7,7 @@ import numpy as np
 from conseval.params import ParamDef
 from conseval.scorer import Scorer
 from conseval.substitution import paramdef_bg_distribution_optional
-from conseval.utils.bio import weighted_freq_count_pseudocount, PSEUDOCOUNT, amino_acids, get_column, weighted_gap_penalty
+from conseval.utils.bio import weighted_freq_count_pseudocount, PSEUDOCOUNT, amino_acids, weighted_gap_penalty, decode_msa
 
 
 class JsDivergence(Scorer):
@@ -31,7 +31,7 @@ class JsDivergence(Scorer):
         if self.use_seq_weights:
             seq_weights = alignment.get_seq_weights()
         else:
-            seq_weights = [1.] * len(alignment.msa)
+            seq_weights = [1.] * len(alignment.msa_array)
 
         if self.bg_distribution is None:
             # Estimate bg distribution from this alignment
@@ -40,9 +40,11 @@ class JsDivergence(Scorer):
         else:
             q = self.bg_distribution
 
-        scores = []
-        for i in xrange(len(alignment.msa[0])):
-            col = get_column(i, alignment.msa)
+        # Identical columns get identical scores, so score each unique column
+        # pattern once.
+        patterns, _, site_patterns = alignment.get_column_patterns()
+        pattern_scores = []
+        for col in decode_msa(patterns.T):
             n_gaps = col.count('-')
             assert n_gaps < len(col)
             if self.gap_cutoff != 1 and n_gaps/len(col) > self.gap_cutoff:
@@ -52,8 +54,8 @@ class JsDivergence(Scorer):
                 if self.use_gap_penalty:
                     # vn_entropy has this commented out for some reason
                     score *= weighted_gap_penalty(col, seq_weights)
-            scores.append(score)
-        return scores
+            pattern_scores.append(score)
+        return [pattern_scores[k] for k in site_patterns]
 
 
     def _score_col(self, col, seq_weights, q):
@@ -8,9 +8,10 @@ from collections import defaultdict
 import numpy as np
 
 from conseval.params import ParamDef
+from conseval.phylotree import iter_clades
 from conseval.scorer import Scorer
-from conseval.substitution import paramdef_sub_model
-from conseval.utils.bio import aa_to_index, get_column
+from conseval.substitution import paramdef_sub_model, N_STATES
+from conseval.utils.bio import GAP_INDEX
 from conseval.utils.gamma import DiscreteGammaDistribution
 
 
@@ -23,6 +24,8 @@ EM_CONVERGENCE = 100
 
 class Rate4siteEb(Scorer):
 
+    USES_TREE = True
+
     params = Scorer.params.extend(
         ParamDef('alpha', 0, float, lambda x: 0<=x<MAX_ALPHA,
             help="alpha parameter into the gamma prior on rate r. Var(r) = 1/alpha. If alpha=0 (default), then the empirical Bayesian estimate of alpha is used."),
@@ -49,8 +52,9 @@ class Rate4siteEb(Scorer):
     def _score(self, alignment):
         # Silly check; return mean if there aren't enough sequences in the
         # alignment to return reasonable scores.
-        if len(alignment.msa) <= 2:
-            return [1] * len(alignment.msa[0])
+        n_seqs, n_sites = alignment.msa_array.shape
+        if n_seqs <= 2:
+            return [1] * n_sites
 
         names_map = dict((name, i) for i, name in enumerate(alignment.names))
         rates, rates_for_est, log_marginal = self._estimate_r(
@@ -83,99 +87,150 @@ class Rate4siteEb(Scorer):
 
 
     def _estimate_r(self, alignment, names_map, prior_distr):
+        """
+        E-step.  Compute each site's rate of evolution r as the expectation of
+        the posterior: E[r|X] = \sum_r( P[X|r] P[r] r ) / \sum_r( P[X|r] P[r] ).
+
+        The likelihoods P[X|r] for all sites and all rates are computed in one
+        pass over the tree, see compute_tree_likelihoods.
+        """
         tree = alignment.get_phylotree()
+        bin_rates = prior_distr.get_rates()
 
         # Pre-compute the probabilities for every branch and rate.
         # This can be done because the discrete gamma distribution tells us
         # which rates P(rt) will be computed for when scoring columns.
-        P_cached = precompute_tree_probs(tree, prior_distr.get_rates(), self.sub_model)
-
-        # E-step
-        rates = []
-        rates_for_est = []
-        log_marginal = 0
-        for i in xrange(len(alignment.msa[0])):
-            col = get_column(i, alignment.msa)
-            n_gaps = col.count('-')
-            assert n_gaps < len(col)
-            if n_gaps == len(col) - 1:
-                # Return mean rate.
-                rate = 1
-            else:
-                rate, marginal = self._estimate_r_col(col, names_map, prior_distr, P_cached, tree)
-                rates_for_est.append(rate)
-                log_marginal += np.log(marginal)
-            rates.append(rate)
-
-        return rates, rates_for_est, log_marginal
-
-
-    def _estimate_r_col(self, col, names_map, prior_distr, P_cached, tree):
-        """
-        Compute this site's rate of evolution r as the expectation of the
-        posterior: E[r|X] = \sum_r( P[X|r] P[r] r ) / \sum_r( P[X|r] P[r] ).
+        P_stacked = precompute_tree_probs_stacked(tree, bin_rates, self.sub_model)
+
+        # Identical columns have identical likelihoods, so only compute them
+        # once for each unique column pattern.
+        msa, counts, site_patterns = alignment.get_column_patterns()
+        n_seqs, n_patterns = msa.shape
+        n_gaps = np.sum(msa == GAP_INDEX, axis=0)
+        assert np.all(n_gaps < n_seqs)
+        # Columns with only one non-gap get the mean rate.
+        is_est = (n_gaps != n_seqs - 1)
+        inds_est = np.flatnonzero(is_est)
+
+        # log P(X|r), shape (rates x patterns)
+        log_likelihoods = compute_tree_log_likelihoods(tree, msa[:,inds_est],
+                names_map, P_stacked, self.sub_model.freqs)
+        # P(X,r).  Since in the discrete gamma model, the probability of each
+        # bin is the same, we don't multiply by the prior.  Likelihoods are
+        # scaled by their max over rates before exponentiating so that they
+        # don't underflow; the scale cancels out in the expectation.
+        log_scale = np.max(log_likelihoods, axis=0)
+        # A pattern whose likelihood underflows to 0 under every rate tells
+        # nothing about its rate, so treat it like the columns with only one
+        # non-gap, rather than get NaNs.
+        is_finite = ~np.isneginf(log_scale)
+        if not np.all(is_finite):
+            is_est[inds_est[~is_finite]] = False
+            inds_est = inds_est[is_finite]
+            log_likelihoods = log_likelihoods[:,is_finite]
+            log_scale = log_scale[is_finite]
+        joints = np.exp(log_likelihoods - log_scale)
+        # Denominator \sum_r( P(X,r) )
+        bot = np.sum(joints, axis=0)
+        # Numerator \sum_r( r*P(X,r) )
+        top = np.dot(bin_rates, joints)
 
-        Assume a fixed alpha until I get it working (leave the inference of the
-        hyperparameter until later).
-        """
-        root = tree.root
+        pattern_rates = np.ones(n_patterns)
+        pattern_rates[inds_est] = top / bot
+        # Each pattern's log marginal counts once for every site it occurs at.
+        log_marginal = np.dot(counts[inds_est], np.log(bot) + log_scale)
 
-        # Numerator \sum_r( r*P(X,r) )
-        top = 0
-        # Denominator \sum_r( P(X,r) )
-        bot = 0
-        for rate in prior_distr.get_rates():
-            # P(X|r)
-            likelihood = compute_subtree_likelihood(root, rate, col, names_map, P_cached)
-            # likelihood None only if column is all gaps
-            assert likelihood is not None
-            # likelihood might be returned as a 1x1 matrix
-            likelihood = float(likelihood)
-            # P(X,r).  Since in the discrete gamma model, the probability of each
-            # bin is the same, we don't multiply by the prior.
-            joint = likelihood
-            top += joint * rate
-            bot += joint
-        expectation = top / bot
-        return expectation, bot
+        # Scatter pattern rates back to sites.
+        rates = pattern_rates[site_patterns]
+        rates_for_est = rates[is_est[site_patterns]]
+
+        return list(rates), list(rates_for_est), log_marginal
 
 
 
 def precompute_tree_probs(tree, rates, sub_model):
+    """
+    Return a dict mapping each rate in `rates` to a dict mapping each node
+    in `tree` to P(rate * t), for the node's branch length t.  The root is
+    mapped to the stationary distribution instead.
+    """
     P_cached = defaultdict(dict)
     root = tree.root
-    rates = set(rates)
+    rates = list(set(rates))
     for rate in rates:
         P_cached[rate][root] = sub_model.freqs
-    bfs = [node for node in root.clades]
-    for node in bfs:
-        t = node.branch_length
-        for rate in rates:
-            P_cached[rate][node] = sub_model.calc_P(rate*t)
-        if not node.is_terminal():
-            bfs += node.clades
+    P_stacked = precompute_tree_probs_stacked(tree, rates, sub_model)
+    for node, Ps in P_stacked.iteritems():
+        for rate, P in zip(rates, Ps):
+            P_cached[rate][node] = P
     return P_cached
 
 
-def compute_subtree_likelihood(node, rate, col, names_map, P_cached):
+def precompute_tree_probs_stacked(tree, rates, sub_model):
+    """
+    Like precompute_tree_probs, but return a dict mapping each non-root node
+    to a (len(rates) x N_STATES x N_STATES) array, whose k-th matrix is
+    P(rates[k] * t) for the node's branch length t.
+    """
+    root = tree.root
+    nodes = [node for node in iter_clades(tree) if node is not root]
+    ts = np.outer([node.branch_length for node in nodes], rates)
+    Ps = sub_model.calc_P_batch(ts).reshape(ts.shape + (N_STATES, N_STATES))
+    return dict(zip(nodes, Ps))
+
+
+def compute_tree_log_likelihoods(tree, msa, names_map, P_stacked, root_freqs):
     """
-    Helper function to compute likelihood via postorder traversal.
+    Compute the log likelihood log P(X|r) of every column X of `msa` under
+    every rate r in `P_stacked`, via Felsenstein pruning.
+
+    The tree is walked once in postorder.  At each node, the partial
+    likelihoods P(subtree below node | state of node's parent) are computed
+    for all rates and all columns at once, as a (rates x columns x N_STATES)
+    array.  Gaps are treated as missing data, i.e. P(gap | parent) = 1.
+
+    To avoid underflow on large trees, the partial likelihoods at each
+    internal node are rescaled so that their max over states is 1, and the
+    logs of the scaling factors are accumulated separately.
+
+    @param msa:
+        (sequences x columns) array of indices into amino_acids, see encode_msa
+    @param names_map:
+        dict mapping sequence names to rows of `msa`
+    @param P_stacked:
+        output of precompute_tree_probs_stacked
+    @param root_freqs:
+        distribution of states at the root
+    @return:
+        (rates x columns) array of log likelihoods
     """
-    if node.is_terminal():
-        aa = col[names_map[node.name]]
-        if aa is '-':
-            # Ignored nodes set to gaps
-            return None
-        P_node_given_parent = P_cached[rate][node][:,aa_to_index[aa]]
-        return P_node_given_parent
-    else:
-        child_P_cols = []
-        for child in node.clades:
-            child_P_col = compute_subtree_likelihood(child, rate, col, names_map, P_cached)
-            if child_P_col is not None:
-                child_P_cols.append(child_P_col)
-        if not child_P_cols:
-            return None
-        P_children_given_node = np.matrix(np.prod(child_P_cols, axis=0))
-        P_subtree_given_parent = P_cached[rate][node] * P_children_given_node
-        return P_subtree_given_parent
+    root = tree.root
+    # Partial likelihoods of nodes whose parent hasn't been visited yet.
+    partials = {}
+    # Accumulated log scaling factors of the partial likelihoods.
+    log_scales = 0
+    for node in iter_clades(tree, order='postorder'):
+        if node.is_terminal():
+            P = P_stacked[node]
+            # Append a column of ones so that gaps select P(gap | parent) = 1.
+            P = np.concatenate((P, np.ones(P.shape[:2] + (1,))), axis=2)
+            partial = P[:,:,msa[names_map[node.name]]].transpose(0,2,1)
+        else:
+            # P(children's subtrees | node)
+            cond = partials.pop(node.clades[0])
+            for child in node.clades[1:]:
+                cond = cond * partials.pop(child)
+            scale = np.max(cond, axis=2)
+            # The likelihood can underflow to 0 at a node with many children,
+            # for rates under which the column is very unlikely.  Leave those
+            # at 0, i.e. log likelihood -inf.
+            scale[scale == 0] = 1
+            cond /= scale[:,:,np.newaxis]
+            log_scales = log_scales + np.log(scale)
+            if node is root:
+                with np.errstate(divide='ignore'):
+                    return np.log(np.dot(cond, root_freqs)) + log_scales
+            # \sum_j P(node=j | parent=i) P(children's subtrees | node=j)
+            partial = np.matmul(cond, P_stacked[node].transpose(0,2,1))
+        partials[node] = partial
+    raise ValueError("Tree root is a terminal node")